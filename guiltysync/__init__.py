@@ -12,22 +12,90 @@ guiltysync - Sync Guilty Gear Strive mods
     You should have received a copy of the GNU Affero General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+from collections import defaultdict
+from concurrent.futures import (
+    BrokenExecutor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+import email.message
+import errno
 import json
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import shutil
+import threading
+import time
+from urllib.parse import urlparse
 
 import click
 import patoolib
 import requests
 
 import guiltysync.helpers as helpers
+import guiltysync.transport as transport
+from guiltysync.cache import MetadataCache
+from guiltysync.extract import ARCHIVE_ERRORS, extract_payload
+from guiltysync.fileutil import hash_file
+from guiltysync.store import ModStore
+from guiltysync.throttle import DownloadThrottle, ThrottledReader
 
 
 class ModNotFound(Exception):
     pass
 
 
-def get_mod_details(mod_id, mod_category=None):
+MOD_CATEGORIES = ("Mod", "Sound")
+
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# (connect, read) - the read timeout applies between chunks, not to the whole download
+DOWNLOAD_TIMEOUT = (5, 30)
+
+# Responses to a relay upload from servers that don't relay mods (older servers
+# don't have the endpoint at all)
+RELAY_UNSUPPORTED_STATUSES = (404, 405, 501)
+
+# Sidecar describing a partially downloaded archive, so that it can be resumed
+DOWNLOAD_STATE_FILENAME = ".download.json"
+
+DOWNLOAD_ERRORS = (
+    click.ClickException,
+    requests.exceptions.RequestException,
+    patoolib.util.PatoolError,
+    *ARCHIVE_ERRORS,
+    OSError,
+    BrokenExecutor,  # An extraction process died
+)
+
+
+def cached_api_get(cache: MetadataCache | None, key: str, url: str, params=None):
+    # Fresh cache entries skip the network, stale ones are only used when offline
+    if cache is not None:
+        data = cache.get(key)
+        if data is not None:
+            return data
+
+    try:
+        res = transport.get(url, params=params)
+        res.raise_for_status()
+    except requests.exceptions.RequestException as exc:
+        data = None if cache is None else cache.get(key, allow_stale=True)
+        if data is not None:
+            return data
+        if isinstance(
+            exc, (requests.exceptions.HTTPError, requests.exceptions.Timeout)
+        ):
+            raise ModNotFound()
+        raise
+
+    data = res.json()
+    if cache is not None:
+        cache.put(key, data)
+    return data
+
+
+def get_mod_details(mod_id, mod_category=None, cache: MetadataCache | None = None):
     if mod_category is None:
         mod_category = (
             "Sound"
@@ -37,19 +105,41 @@ def get_mod_details(mod_id, mod_category=None):
             else "Mod"
         )
 
-    try:
-        res = requests.get(
-            f"https://gamebanana.com/apiv10/{mod_category}/{mod_id}/ProfilePage",
-            timeout=3,
-        )
-        res.raise_for_status()
-    except (requests.exceptions.HTTPError, requests.exceptions.Timeout):
-        raise ModNotFound()
+    return cached_api_get(
+        cache,
+        MetadataCache.profile_key(mod_category, mod_id),
+        f"https://gamebanana.com/apiv10/{mod_category}/{mod_id}/ProfilePage",
+    )
 
-    return res.json()
+
+def find_download(
+    mod_data, cache: MetadataCache | None = None, fetch: bool = True
+) -> dict | None:
+    # GameBanana's entry for the mod's download, from the cached profile or, with
+    # fetch, from the API. Members don't share a mod's category, so both are tried
+    for from_api in (False, True) if fetch else (False,):
+        for mod_category in MOD_CATEGORIES:
+            if from_api:
+                try:
+                    details = get_mod_details(mod_data["id"], mod_category, cache)
+                except (ModNotFound, requests.exceptions.RequestException):
+                    continue
+            elif cache is not None:
+                details = cache.get(
+                    MetadataCache.profile_key(mod_category, mod_data["id"]),
+                    allow_stale=True,
+                )
+            else:
+                continue
+            for download in (details or {}).get("_aFiles") or []:
+                if str(download["_idRow"]) == str(mod_data["download_id"]):
+                    return download
+    return None
 
 
-def search_for_mod(search_string, mod_category=None):
+def search_for_mod(
+    search_string, mod_category=None, cache: MetadataCache | None = None
+):
     if mod_category is None:
         mod_category = (
             "Sound"
@@ -71,14 +161,12 @@ def search_for_mod(search_string, mod_category=None):
                 "_csvFields": "name,owner",
             }
             click.echo(f"Search results for '{search_string}'")
-            try:
-                res = requests.get(
-                    "https://gamebanana.com/apiv10/Util/Search/Results",
-                    params=params,
-                    timeout=3,
-                ).json()
-            except (requests.exceptions.HTTPError, requests.exceptions.Timeout):
-                raise ModNotFound()
+            res = cached_api_get(
+                cache,
+                MetadataCache.search_key(mod_category, search_string),
+                "https://gamebanana.com/apiv10/Util/Search/Results",
+                params=params,
+            )
 
             return helpers.choose_from_list(
                 res["_aRecords"],
@@ -99,33 +187,184 @@ def search_for_mod(search_string, mod_category=None):
                 raise ModNotFound()
 
 
-def download_mod(target_dir: Path, mod_data):
-    if len(list(target_dir.iterdir())) > 0:
-        if click.confirm(
-            f"{target_dir} is not empty. Would you like to empty it? This will delete ALL files in the directory"
-        ):
-            shutil.rmtree(target_dir)
-            target_dir.mkdir()
-        else:
-            raise click.ClickException(f"'{target_dir}' should be empty")
+def get_download_url(mod_data) -> str:
+    return f"https://gamebanana.com/dl/{mod_data['download_id']}"
+
+
+def read_download_state(target_dir: Path) -> dict | None:
+    try:
+        with open(
+            target_dir / DOWNLOAD_STATE_FILENAME, "r", encoding="UTF-8"
+        ) as state_file:
+            return json.load(state_file)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def write_download_state(target_dir: Path, state: dict):
+    with open(
+        target_dir / DOWNLOAD_STATE_FILENAME, "w", encoding="UTF-8"
+    ) as state_file:
+        json.dump(state, state_file)
+
 
-    download_url = f"https://gamebanana.com/dl/{mod_data['download_id']}"
+def get_relay_url(relay: str, mod_data) -> str:
+    return f"{relay}/{mod_data['download_id']}"
 
-    res = requests.get(download_url, timeout=3)
-    res.raise_for_status()
 
+def get_response_filename(res: requests.Response) -> str:
+    # Prefer the name the server gives the file, the relay's URLs have no extension
+    message = email.message.Message()
+    message["Content-Disposition"] = res.headers.get("Content-Disposition", "")
+    filename = message.get_filename()
+    if filename:
+        return PurePosixPath(filename.replace("\\", "/")).name
     assert res.request.url is not None
-    filename = Path(res.request.url.split("/")[-1])
-    target_filepath = target_dir / filename
+    return urlparse(res.request.url).path.split("/")[-1]
 
-    with open(target_filepath, "wb") as downloaded_file:
-        downloaded_file.write(res.content)
 
-    patoolib.extract_archive(
-        target_filepath.as_posix(), outdir=target_dir.as_posix(), verbosity=0
-    )
+def fetch_archive(
+    target_dir: Path,
+    mod_data,
+    download_url: str | None = None,
+    throttle: DownloadThrottle | None = None,
+) -> Path:
+    if download_url is None:
+        download_url = get_download_url(mod_data)
+    state = read_download_state(target_dir)
+    other_state = None
+    if state is not None and state.get("download_url") != download_url:
+        # Started from another source, which may serve a different file. It's kept
+        # until this source answers, so a failed attempt can't lose it
+        other_state, state = state, None
+
+    request_url = download_url
+    headers = {}
+    offset = 0
+    if state is not None:
+        partial_filepath = target_dir / Path(f"{state['filename']}.part")
+        offset = partial_filepath.stat().st_size if partial_filepath.exists() else 0
+        if offset > 0:
+            # Resume against the file URL that the last attempt was redirected to
+            request_url = state["url"]
+            headers["Range"] = f"bytes={offset}-"
+            validator = state.get("etag") or state.get("last_modified")
+            if validator is not None:
+                # The server ignores the range (and sends the whole file) if it changed
+                headers["If-Range"] = validator
+
+    try:
+        res = transport.get(
+            request_url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+        )
+        if res.status_code == 416 and state is not None and offset == state["length"]:
+            res.close()
+            return complete_download(target_dir, state)
+        res.raise_for_status()
+    except requests.exceptions.RequestException:
+        if offset == 0:
+            raise
+        # The stored file URL may have expired, so start over from the download page
+        (target_dir / Path(f"{state['filename']}.part")).unlink(missing_ok=True)
+        (target_dir / DOWNLOAD_STATE_FILENAME).unlink(missing_ok=True)
+        return fetch_archive(target_dir, mod_data, download_url, throttle)
+
+    pauses = throttle.pauses if throttle is not None else 0
+    with res:
+        if res.status_code == 206:
+            mode = "ab"
+        else:
+            mode = "wb"
+            offset = 0
+            if other_state is not None:
+                (target_dir / Path(f"{other_state['filename']}.part")).unlink(
+                    missing_ok=True
+                )
+            assert res.request.url is not None
+            length = res.headers.get("Content-Length")
+            state = {
+                "download_url": download_url,
+                "url": res.request.url,
+                "filename": get_response_filename(res),
+                "length": int(length) if length is not None else None,
+                "etag": res.headers.get("ETag"),
+                "last_modified": res.headers.get("Last-Modified"),
+                "written": 0,
+            }
+            write_download_state(target_dir, state)
+
+        assert state is not None
+        partial_filepath = target_dir / Path(f"{state['filename']}.part")
+
+        written = offset
+        interrupted = False
+        try:
+            # Archives can be hundreds of MB, so never hold one in memory
+            with open(partial_filepath, mode) as downloaded_file:
+                for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    downloaded_file.write(chunk)
+                    written += len(chunk)
+                    if throttle is not None:
+                        throttle.consume(len(chunk))
+        except requests.exceptions.RequestException:
+            if throttle is None or throttle.pauses == pauses:
+                raise
+            interrupted = True
+        finally:
+            state["written"] = written
+            write_download_state(target_dir, state)
+
+    ended_early = state["length"] is not None and written < state["length"]
+    if (
+        (interrupted or ended_early)
+        and throttle is not None
+        and throttle.pauses != pauses
+    ):
+        # The server gave up on the connection while the game was running
+        return fetch_archive(target_dir, mod_data, download_url, throttle)
+
+    if ended_early:
+        raise click.ClickException(
+            f"Download of '{state['filename']}' ended early ({written} of {state['length']} bytes)"
+        )
 
-    for file_ in target_dir.glob("**/*"):
+    return complete_download(target_dir, state)
+
+
+def complete_download(target_dir: Path, state: dict) -> Path:
+    target_filepath = target_dir / Path(state["filename"])
+    (target_dir / Path(f"{state['filename']}.part")).replace(target_filepath)
+    (target_dir / DOWNLOAD_STATE_FILENAME).unlink()
+
+    return target_filepath
+
+
+def upload_archive(
+    relay: str,
+    archive_filepath: Path,
+    mod_data,
+    throttle: DownloadThrottle | None = None,
+) -> int:
+    # Returns the server's status code, a 409 means another member uploaded it first
+    with open(archive_filepath, "rb") as archive_file:
+        res = transport.put(
+            get_relay_url(relay, mod_data),
+            params={"filename": archive_filepath.name},
+            data=(
+                ThrottledReader(archive_file, archive_filepath.stat().st_size, throttle)
+                if throttle is not None
+                else archive_file
+            ),
+            timeout=DOWNLOAD_TIMEOUT,
+        )
+    res.close()
+    return res.status_code
+
+
+def write_mod_id(target_dir: Path, mod_data, files: list[Path] | None = None):
+    if files is None:
+        files = list(target_dir.glob("**/*"))
+    for file_ in files:
         if file_.suffix == ".pak":
             mod_filename = file_.stem
             break
@@ -144,4 +383,223 @@ def download_mod(target_dir: Path, mod_data):
             mod_id_file,
         )
 
-    target_filepath.unlink()
+
+def extract_in_worker(
+    archive_filepath: Path, target_dir: Path
+) -> list[Path] | click.ClickException:
+    # Whatever goes wrong with one archive (encrypted zips raise RuntimeError, for
+    # one) is returned, so it only fails that mod, as an exception that always pickles
+    try:
+        return extract_payload(archive_filepath, target_dir)
+    except Exception as e:
+        return click.ClickException(f"Could not extract '{archive_filepath.name}': {e}")
+
+
+def install_extracted(
+    target_dir: Path,
+    archive_filepath: Path,
+    mod_data,
+    files: list[Path],
+    store: ModStore | None = None,
+):
+    write_mod_id(target_dir, mod_data, files)
+
+    if store is not None:
+        store.add(mod_data["download_id"], archive_filepath, target_dir, files)
+
+    archive_filepath.unlink()
+
+
+def install_from_store(target_dir: Path, store: ModStore, key: str, mod_data):
+    store.materialize(key, target_dir)
+    write_mod_id(target_dir, mod_data)
+
+
+def move_dir(source_dir: Path, target_dir: Path):
+    try:
+        source_dir.rename(target_dir)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Different filesystem, so copy next to the target first and still
+        # finish with a rename
+        copy_dir = target_dir.with_name(f"{target_dir.name}.copy")
+        shutil.rmtree(copy_dir, ignore_errors=True)
+        shutil.copytree(source_dir, copy_dir)
+        copy_dir.rename(target_dir)
+        shutil.rmtree(source_dir)
+
+
+def install_staged(staging_dir: Path, target_dir: Path):
+    # Swaps a finished staging folder in for target_dir. The old version is
+    # only deleted once the new one is in place, and is restored on failure
+    replaced_dir = None
+    if target_dir.exists():
+        replaced_dir = target_dir.with_name(f"{target_dir.name}.old")
+        shutil.rmtree(replaced_dir, ignore_errors=True)
+        target_dir.rename(replaced_dir)
+
+    try:
+        move_dir(staging_dir, target_dir)
+    except OSError:
+        if replaced_dir is not None:
+            replaced_dir.rename(target_dir)
+        raise
+
+    if replaced_dir is not None:
+        shutil.rmtree(replaced_dir, ignore_errors=True)
+
+
+def download_mods(
+    targets: dict,
+    *,
+    store: ModStore | None = None,
+    workers: int = 4,
+    connections_per_host: int = 2,
+    relay: str | None = None,
+    stats: dict | None = None,
+    throttle: DownloadThrottle | None = None,
+    cache: MetadataCache | None = None,
+) -> dict:
+    # targets maps mod ID -> (target_dir, mod_data)
+    # Returns mod ID -> the exception that stopped the mod, or None if it was installed
+    # If relay is set, archives are fetched from (and shared through) the sync server first,
+    # but only used if they match GameBanana's checksum (looked up through cache)
+    # If stats is given, it's filled with the bytes downloaded and the seconds it took
+    # Downloads start in the order of targets, and all of them share the throttle
+    host_limits = defaultdict(lambda: threading.BoundedSemaphore(connections_per_host))
+    host_limits_lock = threading.Lock()
+    relay_enabled = relay is not None
+
+    def fetch_from(download_url, target_dir, mod_data):
+        host = urlparse(download_url).netloc
+        with host_limits_lock:
+            host_limit = host_limits[host]
+        with host_limit:
+            return fetch_archive(target_dir, mod_data, download_url, throttle)
+
+    def fetch(target_dir, mod_data):
+        nonlocal relay_enabled
+
+        # Any member can upload to the relay, so without a checksum it isn't trusted
+        download = find_download(mod_data, cache) if relay_enabled else None
+        checksum = (download or {}).get("_sMd5Checksum")
+        if relay_enabled and checksum:
+            try:
+                archive_filepath = fetch_from(
+                    get_relay_url(relay, mod_data), target_dir, mod_data
+                )
+                if hash_file(archive_filepath, "md5") == checksum.lower():
+                    return archive_filepath
+                archive_filepath.unlink()
+            except requests.exceptions.HTTPError as e:
+                if e.response is not None and e.response.status_code == 501:
+                    relay_enabled = False  # The server doesn't relay mods
+            except (requests.exceptions.RequestException, click.ClickException):
+                pass
+
+        archive_filepath = fetch_from(get_download_url(mod_data), target_dir, mod_data)
+        if relay_enabled:
+            try:
+                status = upload_archive(relay, archive_filepath, mod_data, throttle)
+            except (requests.exceptions.RequestException, OSError):
+                status = None  # Other members will get it from GameBanana instead
+            if status in RELAY_UNSUPPORTED_STATUSES:
+                relay_enabled = False  # Don't send the server any more archives
+        return archive_filepath
+
+    install_targets = {}
+    download_targets = {}
+    for mod_id, (target_dir, mod_data) in targets.items():
+        key = store.get(mod_data["download_id"]) if store is not None else None
+        if key is not None:
+            install_targets[mod_id] = key
+        else:
+            download_targets[mod_id] = (target_dir, mod_data)
+
+    # Decompression is CPU bound, so several archives are extracted in separate
+    # processes. Starting those costs more than extracting a single archive
+    extract_workers = max(1, workers // 2)
+    if len(download_targets) > 1:
+        extract_pool = ProcessPoolExecutor(
+            max_workers=min(extract_workers, len(download_targets))
+        )
+    else:
+        extract_pool = ThreadPoolExecutor(max_workers=1)
+
+    results = {}
+    with ThreadPoolExecutor(
+        max_workers=workers
+    ) as download_pool, extract_pool, ThreadPoolExecutor(
+        max_workers=extract_workers
+    ) as install_pool:
+        installs = {
+            install_pool.submit(
+                install_from_store, targets[mod_id][0], store, key, targets[mod_id][1]
+            ): mod_id
+            for mod_id, key in install_targets.items()
+        }
+        downloads = {
+            download_pool.submit(fetch, target_dir, mod_data): mod_id
+            for mod_id, (target_dir, mod_data) in download_targets.items()
+        }
+
+        # Extraction starts as soon as each archive lands, while other downloads continue
+        extractions = {}
+        downloaded_bytes = 0
+        download_start = time.monotonic()
+        paused_start = throttle.paused_seconds if throttle is not None else 0.0
+        for future in as_completed(downloads):
+            mod_id = downloads[future]
+            target_dir, mod_data = targets[mod_id]
+            try:
+                archive_filepath = future.result()
+            except DOWNLOAD_ERRORS as e:
+                results[mod_id] = e
+                continue
+            downloaded_bytes += archive_filepath.stat().st_size
+            if stats is not None:
+                stats["bytes"] = downloaded_bytes
+                # Time spent paused for the game doesn't count against the speed
+                paused = (
+                    throttle.paused_seconds - paused_start
+                    if throttle is not None
+                    else 0.0
+                )
+                stats["seconds"] = time.monotonic() - download_start - paused
+            extractions[
+                extract_pool.submit(extract_in_worker, archive_filepath, target_dir)
+            ] = (mod_id, archive_filepath)
+
+        for future in as_completed(extractions):
+            mod_id, archive_filepath = extractions[future]
+            target_dir, mod_data = targets[mod_id]
+            try:
+                files = future.result()
+            except DOWNLOAD_ERRORS as e:
+                results[mod_id] = e
+                continue
+            if isinstance(files, Exception):
+                results[mod_id] = files
+                continue
+            # Anything touching the store stays in this process
+            installs[
+                install_pool.submit(
+                    install_extracted,
+                    target_dir,
+                    archive_filepath,
+                    mod_data,
+                    files,
+                    store,
+                )
+            ] = mod_id
+
+        for future in as_completed(installs):
+            mod_id = installs[future]
+            try:
+                future.result()
+                results[mod_id] = None
+            except DOWNLOAD_ERRORS as e:
+                results[mod_id] = e
+
+    return results
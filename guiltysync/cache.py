@@ -0,0 +1,99 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+from pathlib import Path
+import threading
+import time
+
+from guiltysync.fileutil import evict_lru, write_json
+
+
+CACHE_VERSION = 1
+
+
+class MetadataCache:
+    """
+    On-disk cache of GameBanana API responses, shared between runs
+
+    Entries older than `ttl` seconds are refreshed from the network, but are still
+    returned when GameBanana can't be reached. Once the cached responses add up to
+    more than `budget` bytes, the least recently used ones are dropped
+    """
+
+    def __init__(self, cache_filepath: Path, ttl: float, budget: int):
+        self.cache_filepath = cache_filepath
+        self.ttl = ttl
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        try:
+            with open(self.cache_filepath, "r", encoding="UTF-8") as cache_file:
+                self.cache = json.load(cache_file)
+        except (OSError, json.JSONDecodeError):
+            self.cache = None
+
+        if self.cache is None or self.cache.get("version") != CACHE_VERSION:
+            self.cache = {"version": CACHE_VERSION, "entries": {}}
+
+    @classmethod
+    def profile_key(cls, mod_category: str, mod_id) -> str:
+        return f"profile:{mod_category}:{mod_id}"
+
+    @classmethod
+    def search_key(cls, mod_category: str, search_string: str) -> str:
+        return f"search:{mod_category}:{search_string.strip().lower()}"
+
+    def get(self, key: str, allow_stale: bool = False):
+        with self.lock:
+            entry = self.cache["entries"].get(key)
+            if entry is None:
+                return None
+            if not allow_stale and time.time() - entry["fetched"] > self.ttl:
+                return None
+            entry["last_used"] = time.time()
+            self.dirty = True
+            return entry["data"]
+
+    def put(self, key: str, data):
+        now = time.time()
+        with self.lock:
+            self.cache["entries"][key] = {
+                "fetched": now,
+                "last_used": now,
+                "size": len(json.dumps(data)),
+                "data": data,
+            }
+            self.evict(keep=key)
+            self.dirty = True
+
+    def evict(self, keep: str | None = None):
+        entries = self.cache["entries"]
+        evict_lru(
+            [
+                (entry["last_used"], entry["size"], key)
+                for key, entry in entries.items()
+            ],
+            self.budget,
+            entries.pop,
+            keep=keep,
+        )
+
+    def write(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            write_json(self.cache_filepath, self.cache)
+            self.dirty = False
@@ -13,6 +13,7 @@ guiltysync - Sync Guilty Gear Strive mods
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
 from pathlib import Path
@@ -26,16 +27,64 @@ import requests
 
 import guiltysync
 import guiltysync.helpers as helpers
-from guiltysync.cli.server import server
+import guiltysync.transport as transport
+from guiltysync.cache import MetadataCache
+from guiltysync.cli.server import import_config, server
+from guiltysync.identify import identify_mods
+from guiltysync.index import ModIndex
+from guiltysync.plan import (
+    CONFLICT_POLICIES,
+    HAVE,
+    NEED,
+    NEWEST,
+    OTHER,
+    UPDATE,
+    SyncPlan,
+)
+from guiltysync.store import ModStore
+from guiltysync.throttle import DownloadThrottle
+from guiltysync.watch import ChangeWatcher, GroupFollower
+from guiltysync.wire import (
+    COMPACT_FORMAT,
+    expand_members,
+    is_compact,
+    read_changes,
+    read_group,
+)
+
+
+VERSION = "2.0.3"
 
 
 class ServerFailureError(BaseException):
     pass
 
 
+# How much the latest measured download speed counts towards the saved estimate
+THROUGHPUT_WEIGHT = 0.3
+
+
 class SyncClient:
-    def __init__(self, version, config_path: Path, game_path, server):
+    def __init__(
+        self,
+        version,
+        config_path: Path,
+        game_path,
+        server,
+        *,
+        download_workers: int = 4,
+        connections_per_host: int = 2,
+        rescan: bool = False,
+        identify: str = "batch",
+        read_only: bool = False,
+    ):
         self.version = versionLib.parse(version)
+        self.identify = identify
+        # Leaves the config, the mod folder and the local indexes untouched, and
+        # unidentified mods are left out instead of being looked up
+        self.read_only = read_only
+        self.download_workers = download_workers
+        self.connections_per_host = connections_per_host
         self.config_filepath = config_path.resolve()
         self.check_or_create_config()
         self.config = self.read_config()
@@ -47,6 +96,14 @@ class SyncClient:
         self.game_filepath = Path(game_path)
         self.config["defaults"]["game_path"] = self.game_filepath.as_posix()
 
+        transport.configure(
+            connect_timeout=self.config["defaults"].setdefault("connect_timeout", 5),
+            read_timeout=self.config["defaults"].setdefault("read_timeout", 10),
+            retries=self.config["defaults"].setdefault("retries", 3),
+            # Downloads share the session, so keep a connection per download worker
+            pool_size=max(10, download_workers),
+        )
+
         if server is None:
             server = self.config["defaults"].get("server")
             if server is None:
@@ -67,13 +124,53 @@ class SyncClient:
             raise ServerFailureError()
 
         self.selected_group: dict = None  # type: ignore
+        # group name -> {"version", "data"}, so refreshes only fetch what changed
+        self.group_cache = {}
+        self.bulk_sync_supported = True
         if self.default_group is not None:
             self.selected_group = self.groups[self.default_group]
 
+        self.store = ModStore(
+            Path(
+                self.config["defaults"].setdefault(
+                    "store_path",
+                    (self.config_filepath.parent / Path("guiltysync-store")).as_posix(),
+                )
+            ),
+            self.config["defaults"].setdefault("store_budget_mb", 8192) * 1024 * 1024,
+        )
+
+        self.metadata_cache = MetadataCache(
+            self.config_filepath.with_name("guiltysync-cache.json"),
+            self.config["defaults"].setdefault("metadata_cache_ttl_hours", 24) * 3600,
+            self.config["defaults"].setdefault("metadata_cache_mb", 32) * 1024 * 1024,
+        )
+
+        self.conflict_policy = self.config["defaults"].setdefault(
+            "conflict_policy", NEWEST
+        )
+        if self.conflict_policy not in CONFLICT_POLICIES:
+            click.echo(
+                f"Unknown conflict_policy '{self.conflict_policy}', using '{NEWEST}'"
+            )
+            self.conflict_policy = NEWEST
+        self.pinned_members = self.config["defaults"].setdefault("pinned_members", [])
+
+        rate_limit = self.config["defaults"].setdefault("rate_limit_kbps", 0)
+        self.throttle = DownloadThrottle(
+            rate_limit * 1024 if rate_limit > 0 else None,
+            pause_while_playing=self.config["defaults"].setdefault(
+                "pause_while_playing", True
+            ),
+        )
+
         self.write_config()
 
         self.check_directories()
 
+        if rescan:
+            self.mod_index.rebuild()
+
         self.scan_mods()
 
     @property
@@ -96,7 +193,12 @@ class SyncClient:
 
     def check_directories(self):
         mod_root = self.game_filepath / Path("RED", "Content", "Paks")
-        if not mod_root.exists():
+        if self.read_only:
+            if not (mod_root / Path("~mods", "shared")).exists():
+                raise click.ClickException(
+                    "Mod folder (~mods/shared) not found, run a sync first"
+                )
+        elif not mod_root.exists():
             click.echo("Invalid game directory")
             if not self.prompt_launch():
                 raise click.ClickException("Invalid game directory")
@@ -122,15 +224,20 @@ class SyncClient:
                 sys.exit(1)
 
         self.external_dir = self.shared_dir / Path(".external")
-        if not self.external_dir.exists():
+        if not self.external_dir.exists() and not self.read_only:
             self.external_dir.mkdir()
 
+        self.mod_index = ModIndex(
+            self.config_filepath.with_name("guiltysync-index.json"),
+            self.shared_dir,
+            read_only=self.read_only,
+        )
+
     def check_for_update(self):
         try:
-            github_res = requests.get(
+            github_res = transport.get(
                 "https://api.github.com/repos/ThePyrotechnic/guiltysync/releases",
                 params={"per_page": 1},
-                timeout=3,
             )
             github_res.raise_for_status()
         except requests.exceptions.RequestException:
@@ -151,10 +258,9 @@ class SyncClient:
                 f"A new version is available: {release_version} (You have {self.version}). Would you like to update?"
             ):
                 try:
-                    dl_res = requests.get(
+                    dl_res = transport.get(
                         release_info["assets"][0]["url"],
                         headers={"Accept": "application/octet-stream"},
-                        timeout=3,
                     )
                     dl_res.raise_for_status()
                 except requests.exceptions.RequestException:
@@ -174,6 +280,10 @@ class SyncClient:
 
     def check_or_create_config(self):
         if not self.config_filepath.exists():
+            if self.read_only:
+                raise click.ClickException(
+                    "GuiltySync config was not found, run a sync first"
+                )
             if click.confirm("GuiltySync config was not found. Create one now?"):
                 default_config = {
                     "version": str(self.version),
@@ -188,16 +298,14 @@ class SyncClient:
                 sys.exit(1)
 
     def check_server(self):
-        requests.get(self.server, timeout=3).raise_for_status()
+        transport.get(self.server).raise_for_status()
 
     def create_group(self):
         while True:
             group_name = click.prompt("Enter a group name to join or create a group")
             method = "PUT"
             try:
-                requests.get(
-                    f"{self.server}/groups/{group_name}", timeout=3
-                ).raise_for_status()
+                transport.get(f"{self.server}/groups/{group_name}").raise_for_status()
             except requests.exceptions.HTTPError as e:
                 if e.response.status_code == 404:
                     method = "POST"  # Creating a new group
@@ -212,7 +320,7 @@ class SyncClient:
 
             nickname = click.prompt("Enter a nickname for yourself in this group")
             try:
-                requests.request(
+                transport.request(
                     method,
                     f"{self.server}/groups/{group_name}/{nickname if method == 'PUT' else ''}",
                     json={
@@ -223,7 +331,6 @@ class SyncClient:
                             if data["external"] is False
                         },
                     },
-                    timeout=3,
                 ).raise_for_status()
             except requests.exceptions.RequestException as e:
                 raise ServerFailureError(e)
@@ -232,59 +339,233 @@ class SyncClient:
             group_name: {"group_name": group_name, "nickname": nickname}
         }
 
-    def get_mod_status(self, mod_id: str, download_id: str) -> dict[str, bool]:
-        status = {"have_mod": False, "have_download": False}
-        if mod_id in self.mods:
-            status["have_mod"] = True
-            if download_id == self.mods[mod_id]["chosen_download"]:
-                status["have_download"] = True
-
-        return status
+    def sync_plan(self) -> SyncPlan:
+        return SyncPlan(
+            self.group_data,
+            self.mods,
+            self.selected_group["nickname"],
+            policy=self.conflict_policy,
+            pinned_members=self.pinned_members,
+        )
 
-    def get_needed_mod_info(self) -> dict:
-        needed_mod_info = {"to_update": {}, "to_download": {}}
+    def get_needed_mod_info(self, plan: SyncPlan | None = None) -> dict:
+        if plan is None:
+            plan = self.sync_plan()
+        return {"to_update": plan.to_update, "to_download": dict(plan.to_download)}
 
-        for nick, mods in self.group_data.items():
-            if nick == self.selected_group["nickname"]:
-                continue
+    def download_priority(self, plan: SyncPlan, mods: dict) -> list[str]:
+        # Mods shared by the most members first, so most of the group is playable
+        # soonest, then the smallest. Sizes that aren't cached are looked up last
+        sizes = self.estimate_download_sizes(mods, probe=False)
 
-            for mod_id, mod_data in mods.items():
-                mod_status = self.get_mod_status(mod_id, mod_data["download_id"])
-                if mod_status["have_mod"]:
-                    if not mod_status["have_download"]:
-                        needed_mod_info["to_update"][mod_id] = mod_data
-                else:
-                    needed_mod_info["to_download"][mod_id] = mod_data
+        def priority(mod_id):
+            owners = plan.group_index[mod_id][mods[mod_id]["download_id"]]["owners"]
+            size = sizes[mod_id][0]
+            return (-len(owners), size is None, size or 0)
 
-        return needed_mod_info
+        return sorted(mods, key=priority)
 
     def get_or_update_mods(self):
-        needed_mod_info = self.get_needed_mod_info()
+        plan = self.sync_plan()
+        needed_mod_info = self.get_needed_mod_info(plan)
 
         for mod_id, mod_data in needed_mod_info["to_update"].items():
-            # Have mod locally but with different download ID
-            # so need to "update" mod by deleting it first
-            # and then add it to the download list
-            self.mods[mod_id]["pak"].unlink()
-            self.mods[mod_id]["pak"].with_suffix(".id").unlink()
-            self.mods[mod_id]["sig"].unlink()
+            # Have mod locally but with different download ID, so download
+            # the new version and delete the old one once it is installed
             needed_mod_info["to_download"][mod_id] = mod_data
             click.echo(f"'{mod_data['name']}' will be updated...")
 
-        for mod_id, mod_data in needed_mod_info["to_download"].items():
-            click.echo(f"Downloading '{mod_data['name']}'...")
-            mod_dir = self.external_dir / Path(mod_data["id"])
-            mod_dir.mkdir()
+        targets = {}
+        to_download = needed_mod_info["to_download"]
+        for mod_id in self.download_priority(plan, to_download):
+            mod_data = to_download[mod_id]
+            # Downloaded and extracted outside of ~mods, then moved in once complete
+            staging_dir = self.store.staging_dir / Path(mod_data["id"])
+            if guiltysync.read_download_state(staging_dir) is None:
+                # Nothing to resume, so clear out anything left by a failed attempt
+                shutil.rmtree(staging_dir, ignore_errors=True)
+            staging_dir.mkdir(parents=True, exist_ok=True)
+            targets[mod_id] = (staging_dir, mod_data)
+
+        if len(targets) > 0:
+            click.echo(f"Downloading {len(targets)} mod(s)...")
+            download_stats = {}
+            results = guiltysync.download_mods(
+                targets,
+                store=self.store,
+                workers=self.download_workers,
+                connections_per_host=self.connections_per_host,
+                relay=(
+                    f"{self.server}/blobs"
+                    if self.config["defaults"].get("use_relay", True)
+                    else None
+                ),
+                stats=download_stats,
+                throttle=self.throttle,
+                cache=self.metadata_cache,
+            )
+            self.record_throughput(download_stats)
+            for mod_id, error in results.items():
+                staging_dir, mod_data = targets[mod_id]
+                if error is None:
+                    try:
+                        self.install_staged_mod(mod_id, staging_dir, mod_data)
+                    except OSError as e:
+                        error = e
+                if error is None:
+                    click.echo(f"\tDownloaded '{mod_data['name']}'")
+                else:
+                    click.echo(
+                        f"\tAn error occured while downloading '{mod_data['name']}': {error}"
+                    )
+
+        self.scan_mods()
+
+    def install_staged_mod(self, mod_id: str, staging_dir: Path, mod_data: dict):
+        mod_dir = self.external_dir / Path(mod_data["id"])
+        guiltysync.install_staged(staging_dir, mod_dir)
+
+        # An older version that lived elsewhere (e.g. in the shared folder) is
+        # only removed now that its replacement is installed
+        old_mod = self.mods.get(mod_id)
+        if old_mod is not None and mod_dir.resolve() not in old_mod["pak"].parents:
+            for old_filepath in (
+                old_mod["pak"],
+                old_mod["pak"].with_suffix(".id"),
+                old_mod.get("sig"),
+            ):
+                if old_filepath is not None:
+                    old_filepath.unlink(missing_ok=True)
+
+    def record_throughput(self, download_stats: dict):
+        if download_stats.get("bytes", 0) == 0 or download_stats.get("seconds", 0) <= 0:
+            return
+        throughput = download_stats["bytes"] / download_stats["seconds"]
+        previous = self.config["defaults"].get("download_throughput")
+        if previous is not None:
+            # Exponentially weighted, so one unusually slow or fast sync doesn't dominate
+            throughput = (
+                THROUGHPUT_WEIGHT * throughput + (1 - THROUGHPUT_WEIGHT) * previous
+            )
+        self.config["defaults"]["download_throughput"] = throughput
+        self.write_config()
+
+    def estimate_download_sizes(self, mods: dict, probe: bool = True) -> dict:
+        # mod ID -> (archive size in bytes or None if unknown, where the size came from)
+        # Sizes that aren't known locally are only requested from GameBanana with probe
+        estimates = {}
+        pending = {}
+        for mod_id, mod_data in mods.items():
+            store_entry = self.store.peek(mod_data["download_id"])
+            if store_entry is not None:
+                estimates[mod_id] = (0, "store")
+                continue
+            download = guiltysync.find_download(
+                mod_data, self.metadata_cache, fetch=False
+            )
+            if download is not None:
+                estimates[mod_id] = (download["_nFilesize"], "GameBanana")
+            else:
+                pending[mod_id] = mod_data
 
+        def head(mod_data):
             try:
-                guiltysync.download_mod(mod_dir, mod_data)
-            except click.ClickException as e:
-                click.echo(e)
-                click.echo(f"An error occured while downloading '{mod_data['name']}")
+                res = transport.request(
+                    "HEAD", guiltysync.get_download_url(mod_data), allow_redirects=True
+                )
+                res.raise_for_status()
+            except requests.exceptions.RequestException:
+                return None
+            length = res.headers.get("Content-Length")
+            return int(length) if length is not None else None
 
-        self.scan_mods()
+        if not probe:
+            return estimates | {mod_id: (None, None) for mod_id in pending}
+
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            for mod_id, size in zip(pending, executor.map(head, pending.values())):
+                estimates[mod_id] = (size, "HEAD")
+
+        return estimates
+
+    def local_mod_size(self, mod_info: dict) -> int:
+        size = 0
+        for key in ("pak", "sig"):
+            try:
+                size += mod_info[key].stat().st_size
+            except (KeyError, OSError):
+                pass
+        return size
+
+    def print_sync_plan(self):
+        plan = self.sync_plan()
+        downloads = plan.to_download | plan.to_update
+        estimates = self.estimate_download_sizes(downloads)
+
+        download_bytes = 0
+        unknown = 0
+        disk_delta = 0
+        for title, mods in (
+            ("To download", plan.to_download),
+            ("To update", plan.to_update),
+        ):
+            if not mods:
+                continue
+            click.echo(f"{title}:")
+            for mod_id, mod_data in mods.items():
+                size, source = estimates[mod_id]
+                if source == "store":
+                    # Restored from the store, so only the disk use changes
+                    entry = self.store.peek(mod_data["download_id"])
+                    disk_delta += entry["size"]
+                    size_string = "in local store"
+                elif size is None:
+                    unknown += 1
+                    size_string = "size unknown"
+                else:
+                    download_bytes += size
+                    # Mod archives barely compress, so the archive size is close enough
+                    disk_delta += size
+                    size_string = helpers.format_size(size)
+                if mod_id in plan.to_update:
+                    disk_delta -= self.local_mod_size(self.mods[mod_id])
+                click.echo(f"\t{mod_data['name']} ({size_string})")
+
+        if plan.to_prune:
+            click.echo("To remove:")
+            for mod_info in plan.to_prune.values():
+                size = self.local_mod_size(mod_info)
+                disk_delta -= size
+                click.echo(f"\t{mod_info['name']} ({helpers.format_size(size)})")
+
+        if not downloads and not plan.to_prune:
+            click.echo("Everything is up to date")
+            return
+
+        click.echo(
+            f"Total download: {helpers.format_size(download_bytes)}"
+            + (f" (+ {unknown} of unknown size)" if unknown else "")
+        )
+        throughput = self.config["defaults"].get("download_throughput")
+        if throughput:
+            click.echo(
+                f"Estimated time: {helpers.format_duration(download_bytes / throughput)}"
+                f" at {helpers.format_size(throughput)}/s"
+            )
+        else:
+            click.echo("Estimated time: unknown until a sync has downloaded something")
+        click.echo(
+            f"Disk space: {'+' if disk_delta >= 0 else '-'}{helpers.format_size(abs(disk_delta))}"
+        )
 
     def print_group_mods(self):
+        plan = self.sync_plan()
+        status_strings = {
+            HAVE: "✅[HAVE]",
+            UPDATE: "🔄[UPDATE]",
+            NEED: "🔽[NEED]",
+            OTHER: "⏭️[OTHER VERSION]",
+        }
         for nick, mods in self.group_data.items():
             if nick == self.selected_group["nickname"]:
                 click.echo(f"{nick} (you):")
@@ -292,16 +573,10 @@ class SyncClient:
                 click.echo(f"{nick}:")
 
             for mod_data in mods.values():
-                mod_status = self.get_mod_status(
-                    mod_data["id"], mod_data["download_id"]
+                mod_status = plan.mod_status(
+                    mod_data["id"], mod_data["download_id"], mod_data.get("hash")
                 )
-                if mod_status["have_mod"]:
-                    status_string = "✅[HAVE]"
-                    if not mod_status["have_download"]:
-                        status_string = "🔄[UPDATE]"
-                else:
-                    status_string = "🔽[NEED]"
-                click.echo(f"\t{status_string} {mod_data['name']}")
+                click.echo(f"\t{status_strings[mod_status]} {mod_data['name']}")
 
     def print_local_shared_mods(self):
         click.echo("Your shared mods:")
@@ -312,27 +587,7 @@ class SyncClient:
         ]
 
     def prune_external_mods(self):
-        local_external_ids_to_delete = {
-            mod_id: mod_data
-            for mod_id, mod_data in self.mods.items()
-            if mod_data["external"]
-        }
-
-        for their_mods in self.group_data.values():
-            for their_mod_id, their_mod_data in their_mods.items():
-                try:
-                    # If their_mod_id is found locally and the download_id matches, remove that mod ID from the deletion list
-                    if (
-                        local_external_ids_to_delete[their_mod_id]["chosen_download"]
-                        == their_mod_data["download_id"]
-                    ):
-                        del local_external_ids_to_delete[their_mod_id]
-                    # else the download IDs do not match, so leave the mod ID in the deletion queue
-                # A keyError means the mod was not found locally, so it hasn't been downloaded yet
-                except KeyError:
-                    pass
-
-        for mod_data in local_external_ids_to_delete.values():
+        for mod_data in self.sync_plan().to_prune.values():
             shutil.rmtree(mod_data["parent_dir"])
 
         self.scan_mods()
@@ -358,19 +613,15 @@ class SyncClient:
     def scan_mods(self):
         mods = defaultdict(dict)
 
-        for file_ in self.shared_dir.glob("**/*"):
+        for file_, top_level_dir, id_data in self.mod_index.scan():
             if file_.suffix == ".pak":
                 mods[file_.stem]["filename"] = file_.stem
-                mods[file_.stem]["parent_dir"] = file_.parent.resolve()
-                mods[file_.stem]["external"] = file_.resolve().is_relative_to(
-                    self.external_dir
-                )
+                mods[file_.stem]["parent_dir"] = file_.parent
+                mods[file_.stem]["external"] = top_level_dir == self.external_dir.name
                 mods[file_.stem]["pak"] = file_
             elif file_.suffix == ".sig":
                 mods[file_.stem]["sig"] = file_
             elif file_.suffix == ".id":
-                with open(file_, "r", encoding="UTF-8") as id_file:
-                    id_data = json.load(id_file)
                 mods[file_.stem]["id"] = id_data["id"]
                 mods[file_.stem]["name"] = id_data["name"]
                 mods[file_.stem]["chosen_download"] = id_data["chosen_download"]
@@ -384,6 +635,8 @@ class SyncClient:
                         relative_sig_filepath = mods[mod_filename]["parent_dir"] / Path(
                             f"{mod_filename}.sig"
                         )
+                        if self.read_only:  # A sync would copy it
+                            continue
                         sig_filepath = self.shared_dir / relative_sig_filepath
                         game_sig_filepath = self.game_filepath / Path(
                             "RED", "Content", "Paks", "pakchunk0-WindowsNoEditor.sig"
@@ -399,9 +652,28 @@ class SyncClient:
         for invalid_mod in invalid_mods:
             del mods[invalid_mod]
 
+        self.identify_by_hash(mods)
+
+        if self.read_only:
+            unidentified = sum(
+                1 for mod_info in mods.values() if not mod_info.get("id")
+            )
+            if unidentified:
+                click.echo(
+                    f"Leaving out {unidentified} unidentified mods, a sync would look them up first"
+                )
+        elif self.identify == "batch":
+            self.identify_in_batch(
+                [mod_info for mod_info in mods.values() if not mod_info.get("id")]
+            )
+
         mods_by_id = {}
         for mod_info in mods.values():
-            if not mod_info.get("id"):
+            if (
+                not mod_info.get("id")
+                and not mod_info.get("skipped")
+                and not self.read_only
+            ):
                 while True:
                     click.echo(f"Mod ID not found for '{mod_info['filename']}'")
                     choices = ["Search online", "Enter mod ID manually", "Skip"]
@@ -413,11 +685,12 @@ class SyncClient:
                         try:
                             click.echo(f"Searching online...")
                             online_mod_info = guiltysync.search_for_mod(
-                                mod_info["filename"]
+                                mod_info["filename"], cache=self.metadata_cache
                             )
                             online_mod_details = guiltysync.get_mod_details(
                                 online_mod_info["_idRow"],
                                 online_mod_info["_sModelName"],
+                                cache=self.metadata_cache,
                             )
                             mod_info["id"] = str(online_mod_info["_idRow"])
                             mod_info["name"] = online_mod_details["_sName"]
@@ -428,7 +701,9 @@ class SyncClient:
                     elif choice == choices[1]:
                         entered_id = click.prompt("Enter the mod ID")
                         try:
-                            online_mod_details = guiltysync.get_mod_details(entered_id)
+                            online_mod_details = guiltysync.get_mod_details(
+                                entered_id, cache=self.metadata_cache
+                            )
                             mod_info["id"] = entered_id
                             mod_info["name"] = online_mod_details["_sName"]
                             mod_info["downloads"] = online_mod_details["_aFiles"]
@@ -438,6 +713,8 @@ class SyncClient:
                     else:
                         click.echo("Skipping mod...")
                         break
+            if not mod_info.get("id"):
+                continue
 
             if mod_info.get("id") and not mod_info.get("chosen_download"):
                 if len(mod_info["downloads"]) > 1:
@@ -453,25 +730,154 @@ class SyncClient:
                         mod_info["downloads"][0]["_idRow"]
                     )
 
-                with open(
-                    mod_info["pak"].with_suffix(".id"),
-                    "w",
-                    encoding="UTF-8",
-                ) as mod_id_file:
-                    json.dump(
-                        {
-                            "id": mod_info["id"],
-                            "name": mod_info["name"],
-                            "chosen_download": mod_info["chosen_download"],
-                        },
-                        mod_id_file,
-                    )
+                self.write_mod_id_file(mod_info)
+                self.mod_index.remember(mod_info["hash"], self.mod_id_data(mod_info))
 
             mods_by_id[mod_info["id"]] = mod_info
+            # Saved as we go, so lookups aren't repeated if the scan is interrupted
+            if not self.read_only:
+                self.metadata_cache.write()
 
+        self.mod_index.write()
         self.mods = mods_by_id
 
-    def select_group(self):
+    @classmethod
+    def mod_id_data(cls, mod_info: dict) -> dict:
+        return {
+            "id": mod_info["id"],
+            "name": mod_info["name"],
+            "chosen_download": mod_info["chosen_download"],
+        }
+
+    def write_mod_id_file(self, mod_info: dict):
+        with open(
+            mod_info["pak"].with_suffix(".id"),
+            "w",
+            encoding="UTF-8",
+        ) as mod_id_file:
+            json.dump(self.mod_id_data(mod_info), mod_id_file)
+
+    def identify_by_hash(self, mods: dict):
+        hashes = self.mod_index.hash_paks(
+            [mod_info["pak"] for mod_info in mods.values()]
+        )
+
+        # Learn what other members' mods contain, then our own identified mods,
+        # which take precedence
+        for cached in self.group_cache.values():
+            for their_mods in cached["data"].values():
+                for their_mod_data in their_mods.values():
+                    if their_mod_data.get("hash"):
+                        self.mod_index.remember(
+                            their_mod_data["hash"],
+                            {
+                                "id": their_mod_data["id"],
+                                "name": their_mod_data["name"],
+                                "chosen_download": their_mod_data["download_id"],
+                            },
+                        )
+        for mod_info in mods.values():
+            mod_info["hash"] = hashes[mod_info["pak"]]
+            if mod_info.get("id") and mod_info.get("chosen_download"):
+                self.mod_index.remember(mod_info["hash"], self.mod_id_data(mod_info))
+
+        for mod_info in mods.values():
+            if mod_info.get("id"):
+                continue
+            id_data = self.mod_index.recognise(mod_info["hash"])
+            if id_data is not None:
+                mod_info.update(id_data)
+                if not self.read_only:
+                    self.write_mod_id_file(mod_info)
+                click.echo(
+                    f"Identified '{mod_info['filename']}' as '{mod_info['name']}' by its contents"
+                )
+
+    def identify_in_batch(self, unknown_mods: list[dict]):
+        if not unknown_mods:
+            return
+
+        click.echo(f"Searching online for {len(unknown_mods)} unidentified mods...")
+        results = identify_mods(
+            [mod_info["filename"] for mod_info in unknown_mods],
+            cache=self.metadata_cache,
+        )
+
+        ambiguous = []
+        for mod_info in unknown_mods:
+            identification = results[mod_info["filename"]]
+            if identification.match is not None:
+                record, details, download = identification.match
+                mod_info["id"] = str(record["_idRow"])
+                mod_info["name"] = details["_sName"]
+                mod_info["downloads"] = details["_aFiles"]
+                mod_info["chosen_download"] = str(download["_idRow"])
+                click.echo(
+                    f"Identified '{mod_info['filename']}' as '{mod_info['name']}' ({download['_sFile']})"
+                )
+            else:
+                ambiguous.append(mod_info)
+
+        if not ambiguous:
+            return
+
+        def describe(mod_info):
+            guess = results[mod_info["filename"]].best_guess()
+            if guess is None:
+                return f"{mod_info['filename']} -> no results"
+            record, details = guess
+            return f"{mod_info['filename']} -> '{details['_sName']}' ({record['_sModelName']} {record['_idRow']})"
+
+        click.echo("These mods could not be matched by file name:")
+        helpers.print_iterable(ambiguous, display_fn=describe)
+        while True:
+            answer = click.prompt(
+                "Enter the numbers of the guesses to accept, or 'all'",
+                default="",
+                show_default=False,
+            )
+            try:
+                if answer.strip().lower() == "all":
+                    accepted = set(range(1, len(ambiguous) + 1))
+                else:
+                    accepted = {int(part) for part in answer.replace(",", " ").split()}
+            except ValueError:
+                click.echo("Invalid choice")
+                continue
+            if accepted <= set(range(1, len(ambiguous) + 1)):
+                break
+            click.echo("Invalid choice")
+
+        remaining = []
+        for number, mod_info in enumerate(ambiguous, 1):
+            guess = results[mod_info["filename"]].best_guess()
+            if number in accepted and guess is not None:
+                record, details = guess
+                mod_info["id"] = str(record["_idRow"])
+                mod_info["name"] = details["_sName"]
+                mod_info["downloads"] = details["_aFiles"]
+            else:
+                remaining.append(mod_info)
+
+        if remaining and not click.confirm(
+            f"Identify the remaining {len(remaining)} mods one by one?"
+        ):
+            for mod_info in remaining:
+                mod_info["skipped"] = True
+
+    def shared_mod_entries(self) -> dict:
+        return {
+            data["id"]: {
+                "name": data["name"],
+                "id": data["id"],
+                "download_id": data["chosen_download"],
+                "hash": data["hash"],
+            }
+            for data in self.mods.values()
+            if data["external"] is False
+        }
+
+    def select_group(self, publish: bool = True):
         if len(self.groups) == 0:
             click.echo("No previous groups found")
             self.create_group()
@@ -492,48 +898,131 @@ class SyncClient:
 
             self.selected_group = group
 
-            if click.confirm(
+            if not self.read_only and click.confirm(
                 "Would you like to use this group automatically from now on? You can change this later by editing the configuration file"
             ):
                 self.default_group = group["group_name"]
 
-        self.sync_status_with_group()
-
-    def sync_status_with_group(self):
-        self.update_user()
+        self.sync_status_with_group(publish=publish)
 
+    def sync_all_groups(self) -> bool:
+        # Publishes our mods to every group we are in and fetches what changed in
+        # all of them with a single request. Returns False if the server is too old
         try:
-            group_data_res = requests.get(
-                f"{self.server}/groups/{self.selected_group['group_name']}", timeout=3
+            bulk_res = transport.put(
+                f"{self.server}/sync",
+                params={"format": COMPACT_FORMAT},
+                json={
+                    "groups": {
+                        group_name: group["nickname"]
+                        for group_name, group in self.groups.items()
+                    },
+                    "mods": self.shared_mod_entries(),
+                    "versions": {
+                        group_name: cached["version"]
+                        for group_name, cached in self.group_cache.items()
+                    },
+                },
             )
-            group_data_res.raise_for_status()
+            if bulk_res.status_code in (404, 405):
+                return False
+            bulk_res.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise ServerFailureError(e)
+
+        bulk_data = bulk_res.json()
+        if is_compact(bulk_res):
+            for changes in bulk_data["groups"].values():
+                changes["members"] = expand_members(changes["members"])
+        for group_name, changes in bulk_data["groups"].items():
+            self.group_cache[group_name] = self.merge_group_changes(
+                self.group_cache.get(group_name, {"data": {}}), changes
+            )
+        for group_name in bulk_data["missing"]:
+            self.group_cache.pop(group_name, None)
+
+        return True
+
+    def sync_status_with_group(self, publish: bool = True):
+        # With publish=False, the group is only read and our mods aren't sent
+        group_name = self.selected_group["group_name"]
+
+        if publish and self.bulk_sync_supported:
+            self.bulk_sync_supported = self.sync_all_groups()
+            if self.bulk_sync_supported:
+                if group_name not in self.group_cache:
+                    raise ServerFailureError(f"Group '{group_name}' not found")
+                self.group_data = self.group_cache[group_name]["data"]
+                return
+
+        if publish:
+            self.update_user()
+
+        cached = self.group_cache.get(group_name)
+
+        try:
+            if cached is not None:
+                try:
+                    changes_res = transport.get(
+                        f"{self.server}/groups/{group_name}/changes",
+                        params={"since": cached["version"], "format": COMPACT_FORMAT},
+                    )
+                    changes_res.raise_for_status()
+                except requests.exceptions.HTTPError:
+                    cached = None  # Older server, or the group is gone
+                else:
+                    if changes_res.status_code != 304:
+                        cached = self.merge_group_changes(
+                            cached, read_changes(changes_res)
+                        )
+
+            if cached is None:
+                group_data_res = transport.get(
+                    f"{self.server}/groups/{group_name}",
+                    params={"format": COMPACT_FORMAT},
+                )
+                group_data_res.raise_for_status()
+                cached = {"version": None, "data": read_group(group_data_res)}
+                etag = group_data_res.headers.get("ETag")
+                if etag is not None:
+                    cached["version"] = int(etag.strip('"'))
         except requests.exceptions.RequestException as e:
             raise ServerFailureError(e)
 
-        self.group_data = group_data_res.json()
+        if cached["version"] is not None:
+            self.group_cache[group_name] = cached
+
+        self.group_data = cached["data"]
+
+    @classmethod
+    def merge_group_changes(cls, cached: dict, changes: dict) -> dict:
+        group_data = changes["members"]
+        if not changes["full"]:
+            group_data = cached["data"] | group_data
+        return {"version": changes["version"], "data": group_data}
+
+    def apply_group_changes(self, changes: dict):
+        # Changes pushed by the server's event feed for the selected group
+        group_name = self.selected_group["group_name"]
+        cached = self.merge_group_changes(self.group_cache[group_name], changes)
+        self.group_cache[group_name] = cached
+        self.group_data = cached["data"]
 
     def update_user(self):
         try:
-            requests.put(
+            transport.put(
                 f"{self.server}/groups/{self.selected_group['group_name']}/{self.selected_group['nickname']}",
                 json={
                     "member": self.selected_group["nickname"],
-                    "mods": {
-                        data["id"]: {
-                            "name": data["name"],
-                            "id": data["id"],
-                            "download_id": data["chosen_download"],
-                        }
-                        for data in self.mods.values()
-                        if data["external"] is False
-                    },
+                    "mods": self.shared_mod_entries(),
                 },
-                timeout=3,
             ).raise_for_status()
         except requests.exceptions.RequestException as e:
             raise ServerFailureError(e)
 
     def write_config(self):
+        if self.read_only:
+            return
         with open(self.config_filepath, "w", encoding="UTF-8") as client_config_file:
             json.dump(self.config, client_config_file, indent=2)
 
@@ -562,10 +1051,39 @@ def cli(ctx):
 @click.option("--server", default=None)
 @click.option("--config", default="guiltysync.json")
 @click.option("--version-check/--no-version-check", default=True)
+@click.option("--download-workers", type=click.IntRange(min=1), default=4)
+@click.option("--connections-per-host", type=click.IntRange(min=1), default=2)
+@click.option(
+    "--rescan", is_flag=True, help="Ignore the saved file index and rescan all mods"
+)
+@click.option(
+    "--identify",
+    type=click.Choice(["batch", "interactive"]),
+    default="batch",
+    help="Look up unidentified mods all at once, or one at a time",
+)
 @cli.command()
-def sync(config, game_dir, server, version_check):
+def sync(
+    config,
+    game_dir,
+    server,
+    version_check,
+    download_workers,
+    connections_per_host,
+    rescan,
+    identify,
+):
     try:
-        client = SyncClient("2.0.3", Path(config), game_dir, server)
+        client = SyncClient(
+            VERSION,
+            Path(config),
+            game_dir,
+            server,
+            download_workers=download_workers,
+            connections_per_host=connections_per_host,
+            rescan=rescan,
+            identify=identify,
+        )
 
         if version_check:
             client.check_for_update()
@@ -612,10 +1130,111 @@ def sync(config, game_dir, server, version_check):
         sys.exit(0)
 
 
+@click.option("--game-dir", default=None)
+@click.option("--server", default=None)
+@click.option("--config", default="guiltysync.json")
+@cli.command()
+def plan(config, game_dir, server):
+    """Show what a sync would download and delete, without changing anything"""
+    try:
+        client = SyncClient(VERSION, Path(config), game_dir, server, read_only=True)
+        if len(client.groups) == 0:
+            click.echo("No groups yet, run a sync first to join one")
+            sys.exit(1)
+
+        client.select_group(publish=False)
+        client.print_sync_plan()
+    except ServerFailureError:
+        click.echo("Unable to communicate with sync server")
+        sys.exit(1)
+
+
+@click.option("--game-dir", default=None)
+@click.option("--server", default=None)
+@click.option("--config", default="guiltysync.json")
+@click.option(
+    "--debounce",
+    type=float,
+    default=2.0,
+    help="Seconds to wait for a burst of changes to settle",
+)
+@click.option(
+    "--poll-interval",
+    type=float,
+    default=5.0,
+    help="Seconds between scans when file notifications are unavailable",
+)
+@click.option(
+    "--follow/--no-follow",
+    default=True,
+    help="Download your group's new mods as soon as they are shared",
+)
+@cli.command()
+def watch(config, game_dir, server, debounce, poll_interval, follow):
+    try:
+        client = SyncClient(VERSION, Path(config), game_dir, server)
+
+        client.select_group()
+
+        client.prune_external_mods()
+
+        client.get_or_update_mods()
+
+        watcher = ChangeWatcher(
+            client.shared_dir,
+            client.mod_index.snapshot,
+            debounce=debounce,
+            poll_interval=poll_interval,
+        )
+        watcher.start()
+        click.echo(
+            f"Watching '{client.shared_dir}' for changes"
+            f"{'' if watcher.uses_notifications else ' (polling)'}. Press Ctrl+C to stop"
+        )
+
+        follower = None
+        group_name = client.selected_group["group_name"]
+        if follow and client.group_cache.get(group_name) is not None:
+            follower = GroupFollower(
+                client.server, group_name, client.group_cache[group_name]["version"]
+            )
+            follower.start()
+
+        try:
+            while True:
+                if watcher.wait(timeout=1.0 if follower is not None else None):
+                    published_mods = client.shared_mod_entries()
+                    client.scan_mods()
+                    if client.shared_mod_entries() != published_mods:
+                        click.echo("Your shared mods changed, updating group...")
+                        client.update_user()
+
+                if follower is not None and not follower.changes.empty():
+                    while not follower.changes.empty():
+                        client.apply_group_changes(follower.changes.get())
+                    click.echo("Your group's mods changed, syncing...")
+                    client.prune_external_mods()
+                    client.get_or_update_mods()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.stop()
+            if follower is not None:
+                follower.stop()
+    except ServerFailureError:
+        click.echo("Unable to communicate with sync server")
+        sys.exit(1)
+
+
 cli.add_command(server)
+cli.add_command(import_config)
 
 
 if __name__ == "__main__":
+    import multiprocessing
     import sys
 
+    # Mods are extracted in worker processes, which frozen executables have to start
+    multiprocessing.freeze_support()
+
     cli(sys.argv[1:])
@@ -0,0 +1,156 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path, PurePosixPath
+import tempfile
+
+from guiltysync.fileutil import evict_lru
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+class IncompleteBlob(Exception):
+    pass
+
+
+class BlobExists(Exception):
+    pass
+
+
+class BlobUpload:
+    def __init__(self, store: "BlobStore", expected_size: int | None):
+        self.store = store
+        self.expected_size = expected_size
+        self.size = 0
+        self.digest = hashlib.sha256()
+        fd, temp_filepath = tempfile.mkstemp(dir=store.temp_dir)
+        self.temp_filepath = Path(temp_filepath)
+        self.temp_file = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.store.max_size:
+            raise BlobTooLarge()
+        self.digest.update(chunk)
+        self.temp_file.write(chunk)
+
+    def abort(self):
+        self.temp_file.close()
+        self.temp_filepath.unlink(missing_ok=True)
+
+
+class BlobStore:
+    """
+    Mod archives relayed between the members of a group, so that only the first
+    member to download a mod has to get it from GameBanana
+
+    Archives are stored by SHA-256 under `objects/`, with a small JSON file per
+    GameBanana download ID pointing at them. Everything is plain files that are
+    swapped in with atomic renames, so several server processes can share the
+    folder. The first upload of a download ID wins, so a member can't replace an
+    archive that others are already being sent. Each read bumps the archive's
+    mtime, and the least recently used archives are removed once the total size
+    goes over `budget`
+    """
+
+    def __init__(self, root: Path, budget: int, max_size: int):
+        self.root = root
+        self.budget = budget
+        self.max_size = max_size
+        self.objects_dir = root / "objects"
+        self.downloads_dir = root / "downloads"
+        self.temp_dir = root / "tmp"
+
+        for dir_ in (self.objects_dir, self.downloads_dir, self.temp_dir):
+            dir_.mkdir(parents=True, exist_ok=True)
+
+    def get(self, download_id: int) -> tuple[Path, dict] | None:
+        download_filepath = self.downloads_dir / f"{download_id}.json"
+        try:
+            with open(download_filepath, "r", encoding="UTF-8") as download_file:
+                blob = json.load(download_file)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+        object_filepath = self.objects_dir / blob["sha256"]
+        try:
+            os.utime(object_filepath)
+        except FileNotFoundError:  # Evicted
+            download_filepath.unlink(missing_ok=True)
+            return None
+        return object_filepath, blob
+
+    def begin_upload(self, download_id: int, expected_size: int | None) -> BlobUpload:
+        if self.get(download_id) is not None:
+            raise BlobExists()
+        if expected_size is not None and expected_size > self.max_size:
+            raise BlobTooLarge()
+        return BlobUpload(self, expected_size)
+
+    def finish_upload(
+        self, upload: BlobUpload, download_id: int, filename: str
+    ) -> dict:
+        upload.temp_file.flush()
+        os.fsync(upload.temp_file.fileno())
+        upload.temp_file.close()
+        if upload.expected_size is not None and upload.size != upload.expected_size:
+            upload.abort()
+            raise IncompleteBlob()
+
+        blob = {
+            "sha256": upload.digest.hexdigest(),
+            "size": upload.size,
+            # Only the name is kept, it ends up in a Content-Disposition header
+            "filename": PurePosixPath(filename.replace("\\", "/")).name
+            or f"{download_id}",
+        }
+        os.replace(upload.temp_filepath, self.objects_dir / blob["sha256"])
+
+        # Another process may be uploading the same download at the same time, so
+        # the download file is linked into place, which fails if it already exists
+        fd, temp_filepath = tempfile.mkstemp(dir=self.temp_dir)
+        try:
+            with os.fdopen(fd, "w", encoding="UTF-8") as download_file:
+                json.dump(blob, download_file)
+            os.link(temp_filepath, self.downloads_dir / f"{download_id}.json")
+        except FileExistsError:
+            raise BlobExists()
+        finally:
+            os.unlink(temp_filepath)
+
+        self.evict(keep=blob["sha256"])
+        return blob
+
+    def evict(self, keep: str | None = None):
+        # Least recently used archives go first. Download files pointing at removed
+        # archives are cleaned up when they are next read
+        objects = []
+        for entry in os.scandir(self.objects_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # Removed by another process
+                continue
+            objects.append((stat.st_mtime, stat.st_size, entry.name))
+
+        evict_lru(
+            objects,
+            self.budget,
+            lambda name: (self.objects_dir / name).unlink(missing_ok=True),
+            keep=keep,
+        )
@@ -0,0 +1,121 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+import os
+from pathlib import Path
+
+from guiltysync.fileutil import write_json
+
+
+def apply_entry(state: dict, entry: dict):
+    # Every entry sets state instead of modifying it, so replaying an entry
+    # that is already part of the snapshot is harmless
+    op = entry["op"]
+    if op == "create_group":
+        state["groups"][entry["group"]] = {entry["member"]: entry["mods"]}
+        state["versions"][entry["group"]] = {
+            "created": entry["version"],
+            "version": entry["version"],
+            "members": {entry["member"]: entry["version"]},
+        }
+    elif op == "put_member":
+        state["groups"][entry["group"]][entry["member"]] = entry["mods"]
+        group_versions = state["versions"][entry["group"]]
+        group_versions["version"] = entry["version"]
+        group_versions["members"][entry["member"]] = entry["version"]
+    elif op == "delete_group":
+        state["groups"].pop(entry["group"], None)
+        state["versions"].pop(entry["group"], None)
+    elif op == "delete_groups":
+        state["groups"] = {}
+        state["versions"] = {}
+    else:
+        raise ValueError(f"Unknown journal operation '{op}'")
+
+    if "version" in entry:
+        state["version"] = max(state.get("version", 0), entry["version"])
+    state["journal_seq"] = entry["seq"]
+
+
+class Journal:
+    """
+    Write-ahead journal of server mutations
+
+    Each mutation is appended (and fsynced) to `<snapshot>.journal`. Once the
+    journal grows past `compact_every` entries, the whole state is written to
+    the snapshot and swapped in with an atomic rename, and the journal is emptied
+    """
+
+    def __init__(self, snapshot_filepath: Path, compact_every: int = 1000):
+        self.snapshot_filepath = snapshot_filepath
+        self.journal_filepath = snapshot_filepath.with_name(
+            f"{snapshot_filepath.name}.journal"
+        )
+        self.compact_every = compact_every
+        self.entries = 0
+        self.journal_file = None
+
+    def load(self) -> dict:
+        try:
+            with open(self.snapshot_filepath, "r", encoding="UTF-8") as snapshot_file:
+                state = json.load(snapshot_file)
+        except FileNotFoundError:
+            state = {"groups": {}}
+        state.setdefault("versions", {})
+        state.setdefault("version", 0)
+        state.setdefault("journal_seq", 0)
+
+        self.entries = 0
+        try:
+            with open(self.journal_filepath, "r", encoding="UTF-8") as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # Torn write from a crash, nothing after it was acknowledged
+                    self.entries += 1
+                    if entry["seq"] > state["journal_seq"]:
+                        apply_entry(state, entry)
+        except FileNotFoundError:
+            pass
+
+        return state
+
+    def close(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+
+    def append(self, entry: dict):
+        self.append_many([entry])
+
+    def append_many(self, entries: list[dict]):
+        assert self.journal_file is not None
+        self.journal_file.write("".join(json.dumps(entry) + "\n" for entry in entries))
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+        self.entries += len(entries)
+
+    def should_compact(self) -> bool:
+        return self.entries >= self.compact_every
+
+    def compact(self, state: dict):
+        write_json(self.snapshot_filepath, state, fsync=True)
+
+        # The snapshot records the last sequence number it contains, so a crash
+        # before the journal is emptied only means some entries are skipped on replay
+        self.close()
+        self.journal_file = open(self.journal_filepath, "w", encoding="UTF-8")
+        self.entries = 0
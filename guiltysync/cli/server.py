@@ -12,25 +12,58 @@ guiltysync - Sync Guilty Gear Strive mods
     You should have received a copy of the GNU Affero General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import asyncio
 from collections import defaultdict
+import contextlib
+import gzip
 import json
+import os
+from pathlib import Path
 from typing import Dict, List
 
 import click
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse
 from pydantic import BaseModel
 import uvicorn
 
+try:
+    import zstandard
+except ImportError:  # Optional dependency, only gzip is offered without it
+    zstandard = None
 
-config_filepath = ""
-config = {}
+from guiltysync.cli.blobs import BlobExists, BlobStore, BlobTooLarge, IncompleteBlob
+from guiltysync.cli.journal import Journal
+from guiltysync.cli.storage import (
+    GroupExists,
+    GroupNotFound,
+    JsonStorage,
+    SqliteStorage,
+    load_json_state,
+)
+from guiltysync.wire import (
+    COMPACT_FORMAT,
+    FORMAT_HEADER,
+    compact_changes,
+    compact_members,
+)
 
 
-def write_config(config_path, config_data):
-    global config
+MAX_POLL_TIMEOUT = 60
+# How often long-polls re-check storage when other worker processes may have changed it
+CROSS_PROCESS_POLL_INTERVAL = 1.0
+SETTINGS_ENV = "GUILTYSYNC_SERVER_SETTINGS"
+# Smaller responses aren't worth compressing
+COMPRESS_MIN_SIZE = 1024
 
-    with open(config_path, "w", encoding="UTF-8") as config_file:
-        json.dump(config_data, config_file)
+storage: JsonStorage | SqliteStorage = None  # type: ignore
+# Only set when the mod archive relay is enabled
+blobs: BlobStore | None = None
+multiple_workers = False
+# group -> [lock, number of requests holding or waiting on it], see group_lock
+group_locks = {}
+# group -> events of the long-poll requests waiting on that group
+group_waiters = defaultdict(set)
 
 
 class UserData(BaseModel):
@@ -38,68 +71,455 @@ class UserData(BaseModel):
     mods: Dict[str, Dict[str, str]]
 
 
-def ping():
+class BulkUserData(BaseModel):
+    # group -> this member's nickname in that group
+    groups: Dict[str, str]
+    mods: Dict[str, Dict[str, str]]
+    # group -> version of the group that the caller already has
+    versions: Dict[str, int] = {}
+
+
+def accepted_encodings(request: Request) -> set[str]:
+    return {
+        coding.split(";")[0].strip().lower()
+        for coding in request.headers.get("Accept-Encoding", "").split(",")
+    }
+
+
+def json_response(
+    request: Request, content, *, compact: bool = False, headers: dict | None = None
+) -> Response:
+    headers = {**(headers or {}), "Vary": "Accept-Encoding"}
+    if compact:
+        headers[FORMAT_HEADER] = COMPACT_FORMAT
+
+    body = json.dumps(content, separators=(",", ":")).encode()
+    if len(body) >= COMPRESS_MIN_SIZE:
+        encodings = accepted_encodings(request)
+        if zstandard is not None and "zstd" in encodings:
+            body = zstandard.ZstdCompressor().compress(body)
+            headers["Content-Encoding"] = "zstd"
+        elif "gzip" in encodings:
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@contextlib.asynccontextmanager
+async def group_lock(group: str):
+    # Mutations of a group are serialized, without making other groups wait. Locks
+    # are dropped once nothing holds or waits on them, so requests for groups that
+    # don't exist don't leave one behind
+    entry = group_locks.setdefault(group, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del group_locks[group]
+
+
+async def ping():
     return
 
 
-def delete_group(group: str):
-    if not group in config["groups"]:
-        raise (HTTPException(status_code=404, detail="Group not found"))
-    del config["groups"][group]
+async def delete_group(group: str):
+    async with group_lock(group):
+        try:
+            await asyncio.to_thread(storage.delete_group, group)
+        except GroupNotFound:
+            raise (HTTPException(status_code=404, detail="Group not found"))
+
+    notify_group_changed(group)
+
 
-    write_config(config_filepath, config)
+async def delete_groups():
+    for group in await asyncio.to_thread(storage.delete_groups):
+        notify_group_changed(group)
 
 
-def delete_groups():
-    config["groups"] = {}
+async def post_group(group: str, user_data: UserData):
+    async with group_lock(group):
+        try:
+            await asyncio.to_thread(
+                storage.create_group, group, user_data.member, user_data.mods
+            )
+        except GroupExists:
+            raise HTTPException(status_code=409, detail="Group already exists")
 
-    write_config(config_filepath, config)
+    notify_group_changed(group)
 
 
-def post_group(group: str, user_data: UserData):
-    if group in config["groups"]:
-        raise HTTPException(status_code=409, detail="Group already exists")
-    config["groups"][group] = {}
-    config["groups"][group][user_data.member] = user_data.mods
+async def post_group_member(group: str, member: str, user_data: UserData):
+    async with group_lock(group):
+        try:
+            changed = await asyncio.to_thread(
+                storage.put_member, group, member, user_data.mods
+            )
+        except GroupNotFound:
+            raise HTTPException(status_code=404, detail="Group not found")
 
-    write_config(config_filepath, config)
+    # If nothing changed, the group's version (and ETag) stays as-is
+    if changed:
+        notify_group_changed(group)
 
 
-def post_group_member(group: str, member: str, user_data: UserData):
+async def get_group(
+    group: str, request: Request, wire_format: str = Query("full", alias="format")
+):
     try:
-        config["groups"][group][member] = user_data.mods
-    except KeyError:
+        version, group_data = await asyncio.to_thread(storage.get_group, group)
+    except GroupNotFound:
         raise HTTPException(status_code=404, detail="Group not found")
 
-    write_config(config_filepath, config)
+    etag = f'"{version}"'
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
 
+    compact = wire_format == COMPACT_FORMAT
+    return json_response(
+        request,
+        compact_members(group_data) if compact else group_data,
+        compact=compact,
+        headers={"ETag": etag},
+    )
 
-def get_group(group: str):
+
+async def get_group_changes(
+    group: str,
+    since: int,
+    request: Request,
+    wire_format: str = Query("full", alias="format"),
+):
     try:
-        return config["groups"][group]
-    except KeyError:
+        version, changes = await asyncio.to_thread(
+            storage.get_group_changes, group, since
+        )
+    except GroupNotFound:
         raise HTTPException(status_code=404, detail="Group not found")
 
+    etag = f'"{version}"'
+    if changes is None:
+        return Response(status_code=304, headers={"ETag": etag})
 
-@click.option("--host", "-h", default="0.0.0.0")
-@click.option("--port", "-p", type=int, default="6969")
-@click.option("--config-path", "-c", default="config.json")
-@click.command()
-def server(host, port, config_path):
-    global config, config_filepath
+    compact = wire_format == COMPACT_FORMAT
+    return json_response(
+        request,
+        compact_changes(changes) if compact else changes,
+        compact=compact,
+        headers={"ETag": etag},
+    )
+
+
+async def put_bulk(
+    user_data: BulkUserData,
+    request: Request,
+    wire_format: str = Query("full", alias="format"),
+):
+    # Updates one member in several groups and returns what changed in each of them
+    # (in the same format as /groups/{group}/changes), all in one round-trip
+    groups = {}
+    missing = []
+    for group, member in user_data.groups.items():
+        async with group_lock(group):
+            try:
+                changed = await asyncio.to_thread(
+                    storage.put_member, group, member, user_data.mods
+                )
+                _, changes = await asyncio.to_thread(
+                    storage.get_group_changes, group, user_data.versions.get(group, -1)
+                )
+            except GroupNotFound:
+                missing.append(group)
+                continue
+
+        if changed:
+            notify_group_changed(group)
+        if changes is not None:
+            groups[group] = changes
 
-    config_filepath = config_path
+    compact = wire_format == COMPACT_FORMAT
+    if compact:
+        groups = {group: compact_changes(changes) for group, changes in groups.items()}
+    return json_response(
+        request, {"groups": groups, "missing": missing}, compact=compact
+    )
 
-    with open(config_filepath, "r", encoding="UTF=8") as config_file:
-        config = json.load(config_file)
 
-    app = FastAPI()
+def check_blobs_enabled() -> BlobStore:
+    if blobs is None:
+        raise HTTPException(status_code=501, detail="Mod relay is disabled")
+    return blobs
+
+
+async def get_blob(download_id: int):
+    blob_store = check_blobs_enabled()
+    found = await asyncio.to_thread(blob_store.get, download_id)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Mod archive not found")
+    object_filepath, blob = found
+
+    # Reads bump the file's mtime, so the default ETag would change every time
+    return FileResponse(
+        object_filepath,
+        filename=blob["filename"],
+        headers={"ETag": f'"{blob["sha256"]}"'},
+    )
+
+
+async def put_blob(download_id: int, filename: str, request: Request):
+    blob_store = check_blobs_enabled()
+    length = request.headers.get("Content-Length")
+    try:
+        upload = await asyncio.to_thread(
+            blob_store.begin_upload,
+            download_id,
+            int(length) if length is not None else None,
+        )
+    except BlobExists:
+        raise HTTPException(status_code=409, detail="Mod archive already uploaded")
+    except BlobTooLarge:
+        raise HTTPException(status_code=413, detail="Mod archive is too large")
+
+    try:
+        async for chunk in request.stream():
+            await asyncio.to_thread(upload.write, chunk)
+        return await asyncio.to_thread(
+            blob_store.finish_upload, upload, download_id, filename
+        )
+    except BlobTooLarge:
+        upload.abort()
+        raise HTTPException(status_code=413, detail="Mod archive is too large")
+    except IncompleteBlob:
+        raise HTTPException(status_code=400, detail="Mod archive upload was cut short")
+    except BlobExists:
+        raise HTTPException(status_code=409, detail="Mod archive already uploaded")
+    except BaseException:
+        upload.abort()  # Client disconnected, or the server is shutting down
+        raise
+
+
+def notify_group_changed(group: str):
+    for event in group_waiters.get(group, ()):
+        event.set()
+
+
+async def get_group_events(
+    group: str,
+    since: int,
+    request: Request,
+    timeout: float = 30,
+    wire_format: str = Query("full", alias="format"),
+):
+    # Long-poll: returns the changes after `since` as soon as there are any,
+    # or a 304 if nothing changed within `timeout` seconds
+    event_loop = asyncio.get_running_loop()
+    deadline = event_loop.time() + min(timeout, MAX_POLL_TIMEOUT)
+
+    event = asyncio.Event()
+    group_waiters[group].add(event)
+    try:
+        while True:
+            try:
+                version, changes = await asyncio.to_thread(
+                    storage.get_group_changes, group, since
+                )
+            except GroupNotFound:
+                raise HTTPException(status_code=404, detail="Group not found")
+
+            etag = f'"{version}"'
+            if changes is not None:
+                compact = wire_format == COMPACT_FORMAT
+                return json_response(
+                    request,
+                    compact_changes(changes) if compact else changes,
+                    compact=compact,
+                    headers={"ETag": etag},
+                )
+
+            remaining = deadline - event_loop.time()
+            if remaining <= 0:
+                return Response(status_code=304, headers={"ETag": etag})
+            if multiple_workers:
+                # Changes made by other processes don't set the event
+                remaining = min(remaining, CROSS_PROCESS_POLL_INTERVAL)
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+    finally:
+        group_waiters[group].discard(event)
+        if len(group_waiters[group]) == 0:
+            del group_waiters[group]
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # uvicorn re-raises SIGINT / SIGTERM once it has shut down, so this is the
+    # last chance to persist anything
+    await asyncio.to_thread(storage.close)
+
+
+def create_app() -> FastAPI:
+    global storage, multiple_workers, blobs
+
+    # Worker processes started by uvicorn only get the settings through the environment
+    settings = json.loads(os.environ[SETTINGS_ENV])
+    if settings["storage"] == "sqlite":
+        storage = SqliteStorage(
+            Path(settings["database_path"]), durability=settings["durability"]
+        )
+    else:
+        storage = JsonStorage(
+            Path(settings["config_path"]),
+            compact_every=settings["compact_every"],
+            durability=settings["durability"],
+            flush_interval=settings["flush_interval"],
+        )
+    storage.open()
+    multiple_workers = settings["workers"] > 1
+    if settings["blob_dir"] is not None:
+        blobs = BlobStore(
+            Path(settings["blob_dir"]),
+            settings["blob_budget_mb"] * 1024 * 1024,
+            settings["blob_max_mb"] * 1024 * 1024,
+        )
+
+    app = FastAPI(lifespan=lifespan)
 
     app.add_api_route("/", ping, methods=["GET"])  # type: ignore
     app.add_api_route("/groups", delete_groups, methods=["DELETE"])  # type: ignore
+    app.add_api_route("/sync", put_bulk, methods=["PUT"])  # type: ignore
     app.add_api_route("/groups/{group}", get_group, methods=["GET"])  # type: ignore
     app.add_api_route("/groups/{group}", post_group, methods=["POST"])  # type: ignore
     app.add_api_route("/groups/{group}", delete_group, methods=["DELETE"])  # type: ignore
+    app.add_api_route("/groups/{group}/changes", get_group_changes, methods=["GET"])  # type: ignore
+    app.add_api_route("/groups/{group}/events", get_group_events, methods=["GET"])  # type: ignore
     app.add_api_route("/groups/{group}/{member}", post_group_member, methods=["PUT"])  # type: ignore
+    app.add_api_route("/blobs/{download_id}", get_blob, methods=["GET"])  # type: ignore
+    app.add_api_route("/blobs/{download_id}", put_blob, methods=["PUT"])  # type: ignore
+
+    return app
+
+
+@click.option("--host", "-h", default="0.0.0.0")
+@click.option("--port", "-p", type=int, default="6969")
+@click.option(
+    "--storage", "storage_type", type=click.Choice(["json", "sqlite"]), default="json"
+)
+@click.option("--config-path", "-c", default="config.json", help="JSON storage file")
+@click.option(
+    "--compact-every",
+    type=click.IntRange(min=1),
+    default=1000,
+    help="Number of journal entries after which the JSON storage file is rewritten",
+)
+@click.option(
+    "--database-path", "-d", default="guiltysync.db", help="SQLite storage file"
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of server processes (requires --storage sqlite if more than 1)",
+)
+@click.option(
+    "--durability",
+    type=click.Choice(["request", "batched"]),
+    default="request",
+    help="Persist every change before responding, or batch changes in the background",
+)
+@click.option(
+    "--flush-interval",
+    type=float,
+    default=1.0,
+    help="Seconds of changes to collect into one write with --durability batched",
+)
+@click.option(
+    "--blob-dir",
+    default=None,
+    help="Folder for relaying mod archives between members (disabled if not set)",
+)
+@click.option(
+    "--blob-budget-mb",
+    type=click.IntRange(min=1),
+    default=10240,
+    help="Total size of relayed archives to keep",
+)
+@click.option(
+    "--blob-max-mb",
+    type=click.IntRange(min=1),
+    default=2048,
+    help="Largest archive that can be relayed",
+)
+@click.command()
+def server(
+    host,
+    port,
+    storage_type,
+    config_path,
+    compact_every,
+    database_path,
+    workers,
+    durability,
+    flush_interval,
+    blob_dir,
+    blob_budget_mb,
+    blob_max_mb,
+):
+    if workers > 1 and storage_type != "sqlite":
+        raise click.BadParameter(
+            "JSON storage lives in one process's memory, use --storage sqlite to run more than 1 worker",
+            param_hint="--workers",
+        )
+
+    os.environ[SETTINGS_ENV] = json.dumps(
+        {
+            "storage": storage_type,
+            "config_path": str(Path(config_path).resolve()),
+            "compact_every": compact_every,
+            "database_path": str(Path(database_path).resolve()),
+            "workers": workers,
+            "durability": durability,
+            "flush_interval": flush_interval,
+            "blob_dir": str(Path(blob_dir).resolve()) if blob_dir is not None else None,
+            "blob_budget_mb": blob_budget_mb,
+            "blob_max_mb": blob_max_mb,
+        }
+    )
+
+    if workers > 1:
+        uvicorn.run(
+            "guiltysync.cli.server:create_app",
+            factory=True,
+            host=host,
+            port=port,
+            workers=workers,
+        )
+    else:
+        uvicorn.run(create_app(), host=host, port=port)
+
+
+@click.argument("database_path", default="guiltysync.db")
+@click.argument("config_path", default="config.json")
+@click.command(name="import-config")
+def import_config(config_path, database_path):
+    """Copy the groups in a JSON server config into an SQLite database"""
+    config_filepath = Path(config_path)
+    if not config_filepath.exists():
+        raise click.ClickException(f"'{config_filepath}' does not exist")
+
+    state = load_json_state(Journal(config_filepath))
+
+    database = SqliteStorage(Path(database_path))
+    database.open()
+    database.import_state(state)
+    database.close()
 
-    uvicorn.run(app, host=host, port=port)
+    click.echo(f"Imported {len(state['groups'])} group(s) into '{database_path}'")
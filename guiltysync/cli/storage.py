@@ -0,0 +1,474 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+from pathlib import Path
+import sqlite3
+import threading
+
+from guiltysync.cli.journal import Journal, apply_entry
+
+
+class GroupNotFound(Exception):
+    pass
+
+
+class GroupExists(Exception):
+    pass
+
+
+def changes_since(
+    group_data: dict, created: int, version: int, member_versions: dict, since: int
+) -> dict | None:
+    # Returns None if nothing changed after `since`
+    if since >= version:
+        return None
+
+    if since < created:
+        # The caller's copy is from before this group existed, so send all of it
+        return {"version": version, "full": True, "members": group_data}
+
+    return {
+        "version": version,
+        "full": False,
+        "members": {
+            member: mods
+            for member, mods in group_data.items()
+            if member_versions.get(member, 0) > since
+        },
+    }
+
+
+def load_json_state(journal: Journal) -> dict:
+    state = journal.load()
+
+    # Config files from older versions have no group versions yet
+    for group, group_data in state["groups"].items():
+        if group not in state["versions"]:
+            state["version"] += 1
+            state["versions"][group] = {
+                "created": state["version"],
+                "version": state["version"],
+                "members": {member: state["version"] for member in group_data},
+            }
+
+    return state
+
+
+class JsonStorage:
+    """
+    Keeps every group in memory, persisted to a JSON snapshot plus a journal
+
+    With "request" durability every mutation is fsynced to the journal before it
+    is applied. With "batched" durability mutations are applied immediately and
+    a background thread writes them out every `flush_interval` seconds with a
+    single fsync, keeping only the latest update of each member
+    """
+
+    def __init__(
+        self,
+        config_filepath: Path,
+        compact_every: int = 1000,
+        durability: str = "request",
+        flush_interval: float = 1.0,
+    ):
+        self.journal = Journal(config_filepath, compact_every=compact_every)
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.state = {}
+
+        self.pending = []
+        # (group, member) -> index in self.pending of its latest put_member entry
+        self.pending_members = {}
+        self.dirty = threading.Event()
+        self.stopped = threading.Event()
+        self.flusher = None
+
+    def open(self):
+        self.state = load_json_state(self.journal)
+
+        # Start every run from a fresh snapshot and an empty journal
+        self.journal.compact(self.state)
+
+        if self.durability == "batched":
+            self.flusher = threading.Thread(target=self.run_flusher, daemon=True)
+            self.flusher.start()
+
+    def close(self):
+        if self.flusher is not None:
+            self.stopped.set()
+            self.dirty.set()
+            self.flusher.join()
+            self.flusher = None
+
+        with self.lock:
+            self.pending = []
+            self.pending_members = {}
+            self.journal.compact(self.state)
+            self.journal.close()
+
+    def run_flusher(self):
+        while not self.stopped.is_set():
+            self.dirty.wait()
+            # Let the mutations within one window pile up, then write them together
+            self.stopped.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.dirty.clear()
+            entries = [entry for entry in self.pending if entry is not None]
+            self.pending = []
+            self.pending_members = {}
+            if len(entries) == 0:
+                return
+
+            self.journal.append_many(entries)
+            if self.journal.should_compact():
+                self.journal.compact(self.state)
+
+    def queue_entry(self, entry: dict):
+        if entry["op"] == "put_member":
+            key = (entry["group"], entry["member"])
+            previous = self.pending_members.get(key)
+            if previous is not None:
+                self.pending[previous] = None  # Superseded by this update
+            self.pending_members[key] = len(self.pending)
+        else:
+            # Creating or deleting groups resets them, so updates queued before
+            # this entry must not be merged with updates queued after it
+            self.pending_members = {
+                key: index
+                for key, index in self.pending_members.items()
+                if entry["op"] != "delete_groups" and key[0] != entry["group"]
+            }
+        self.pending.append(entry)
+        self.dirty.set()
+
+    def commit(self, entry: dict):
+        entry["seq"] = self.state["journal_seq"] + 1
+
+        if self.durability == "batched":
+            apply_entry(self.state, entry)
+            self.queue_entry(entry)
+            return
+
+        # Write-ahead: the entry is durable before the in-memory state changes
+        self.journal.append(entry)
+        apply_entry(self.state, entry)
+
+        if self.journal.should_compact():
+            self.journal.compact(self.state)
+
+    def get_group(self, group: str) -> tuple[int, dict]:
+        # Reads hold the lock too, otherwise a PUT landing between reading the
+        # version and copying the group would be sent under the wrong version
+        with self.lock:
+            try:
+                version = self.state["versions"][group]["version"]
+                # Copied so that later PUTs can't change it while it is being sent
+                group_data = dict(self.state["groups"][group])
+            except KeyError:
+                raise GroupNotFound()
+        return version, group_data
+
+    def get_group_changes(self, group: str, since: int) -> tuple[int, dict | None]:
+        with self.lock:
+            try:
+                group_versions = dict(self.state["versions"][group])
+                group_data = dict(self.state["groups"][group])
+                member_versions = dict(group_versions["members"])
+            except KeyError:
+                raise GroupNotFound()
+
+        return group_versions["version"], changes_since(
+            group_data,
+            group_versions["created"],
+            group_versions["version"],
+            member_versions,
+            since,
+        )
+
+    def create_group(self, group: str, member: str, mods: dict):
+        with self.lock:
+            if group in self.state["groups"]:
+                raise GroupExists()
+            self.commit(
+                {
+                    "op": "create_group",
+                    "group": group,
+                    "member": member,
+                    "mods": mods,
+                    "version": self.state["version"] + 1,
+                }
+            )
+
+    def put_member(self, group: str, member: str, mods: dict) -> bool:
+        # Returns False (and keeps the group's version) if nothing changed
+        with self.lock:
+            try:
+                if self.state["groups"][group].get(member) == mods:
+                    return False
+            except KeyError:
+                raise GroupNotFound()
+            self.commit(
+                {
+                    "op": "put_member",
+                    "group": group,
+                    "member": member,
+                    "mods": mods,
+                    "version": self.state["version"] + 1,
+                }
+            )
+            return True
+
+    def delete_group(self, group: str):
+        with self.lock:
+            if not group in self.state["groups"]:
+                raise GroupNotFound()
+            self.commit({"op": "delete_group", "group": group})
+
+    def delete_groups(self) -> list[str]:
+        with self.lock:
+            groups = list(self.state["groups"])
+            self.commit({"op": "delete_groups"})
+            return groups
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS groups (
+    name TEXT PRIMARY KEY,
+    created INTEGER NOT NULL,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS members (
+    group_name TEXT NOT NULL REFERENCES groups (name) ON DELETE CASCADE,
+    member TEXT NOT NULL,
+    mods TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (group_name, member)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS members_by_version ON members (group_name, version);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+"""
+
+# Statements are kept as constants so that sqlite3's statement cache reuses
+# the prepared versions
+SQL_NEXT_VERSION = "UPDATE meta SET value = value + 1 WHERE key = 'version'"
+SQL_GET_VERSION = "SELECT value FROM meta WHERE key = 'version'"
+SQL_GET_GROUP = "SELECT created, version FROM groups WHERE name = ?"
+SQL_GET_MEMBERS = "SELECT member, mods, version FROM members WHERE group_name = ?"
+SQL_GET_CHANGED_MEMBERS = (
+    "SELECT member, mods, version FROM members WHERE group_name = ? AND version > ?"
+)
+SQL_GET_MEMBER_MODS = "SELECT mods FROM members WHERE group_name = ? AND member = ?"
+SQL_INSERT_GROUP = "INSERT INTO groups (name, created, version) VALUES (?, ?, ?)"
+SQL_SET_GROUP_VERSION = "UPDATE groups SET version = ? WHERE name = ?"
+SQL_PUT_MEMBER = (
+    "INSERT INTO members (group_name, member, mods, version) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (group_name, member) DO UPDATE SET mods = excluded.mods, version = excluded.version"
+)
+SQL_DELETE_GROUP = "DELETE FROM groups WHERE name = ?"
+SQL_DELETE_GROUPS = "DELETE FROM groups"
+SQL_LIST_GROUPS = "SELECT name FROM groups"
+
+
+def encode_mods(mods: dict) -> str:
+    return json.dumps(mods, sort_keys=True, separators=(",", ":"))
+
+
+class SqliteStorage:
+    """
+    Keeps groups in an SQLite database (in WAL mode), so that only the groups
+    being requested are loaded and several server processes can share them
+    """
+
+    def __init__(self, database_filepath: Path, durability: str = "request"):
+        self.database_filepath = database_filepath
+        # In WAL mode, NORMAL only syncs at checkpoints, so recent commits can be
+        # lost on power failure (but the database is never corrupted)
+        self.synchronous = "FULL" if durability == "request" else "NORMAL"
+        self.local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections should not be shared between threads
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.database_filepath, timeout=30, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute(f"PRAGMA synchronous = {self.synchronous}")
+            connection.execute("PRAGMA foreign_keys = ON")
+            self.local.connection = connection
+        return connection
+
+    def open(self):
+        self.connection.executescript(SQLITE_SCHEMA)
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def write_transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so the version counter
+        # can't be raced by another thread or process
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        return connection
+
+    def next_version(self, connection: sqlite3.Connection) -> int:
+        connection.execute(SQL_NEXT_VERSION)
+        return connection.execute(SQL_GET_VERSION).fetchone()[0]
+
+    def get_group(self, group: str) -> tuple[int, dict]:
+        connection = self.connection
+        connection.execute("BEGIN")
+        try:
+            group_row = connection.execute(SQL_GET_GROUP, (group,)).fetchone()
+            if group_row is None:
+                raise GroupNotFound()
+            members = connection.execute(SQL_GET_MEMBERS, (group,)).fetchall()
+        finally:
+            connection.execute("COMMIT")
+
+        return group_row[1], {member: json.loads(mods) for member, mods, _ in members}
+
+    def get_group_changes(self, group: str, since: int) -> tuple[int, dict | None]:
+        connection = self.connection
+        connection.execute("BEGIN")
+        try:
+            group_row = connection.execute(SQL_GET_GROUP, (group,)).fetchone()
+            if group_row is None:
+                raise GroupNotFound()
+            created, version = group_row
+            if since >= version:
+                return version, None
+
+            full = since < created
+            members = connection.execute(
+                *(
+                    (SQL_GET_MEMBERS, (group,))
+                    if full
+                    else (SQL_GET_CHANGED_MEMBERS, (group, since))
+                )
+            ).fetchall()
+        finally:
+            connection.execute("COMMIT")
+
+        return version, {
+            "version": version,
+            "full": full,
+            "members": {member: json.loads(mods) for member, mods, _ in members},
+        }
+
+    def create_group(self, group: str, member: str, mods: dict):
+        connection = self.write_transaction()
+        try:
+            if connection.execute(SQL_GET_GROUP, (group,)).fetchone() is not None:
+                raise GroupExists()
+            version = self.next_version(connection)
+            connection.execute(SQL_INSERT_GROUP, (group, version, version))
+            connection.execute(
+                SQL_PUT_MEMBER, (group, member, encode_mods(mods), version)
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def put_member(self, group: str, member: str, mods: dict) -> bool:
+        # Returns False (and keeps the group's version) if nothing changed
+        encoded_mods = encode_mods(mods)
+        connection = self.write_transaction()
+        try:
+            if connection.execute(SQL_GET_GROUP, (group,)).fetchone() is None:
+                raise GroupNotFound()
+            current = connection.execute(
+                SQL_GET_MEMBER_MODS, (group, member)
+            ).fetchone()
+            if current is not None and current[0] == encoded_mods:
+                connection.execute("ROLLBACK")
+                return False
+            version = self.next_version(connection)
+            connection.execute(SQL_PUT_MEMBER, (group, member, encoded_mods, version))
+            connection.execute(SQL_SET_GROUP_VERSION, (version, group))
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return True
+
+    def delete_group(self, group: str):
+        connection = self.write_transaction()
+        try:
+            if connection.execute(SQL_DELETE_GROUP, (group,)).rowcount == 0:
+                raise GroupNotFound()
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def delete_groups(self) -> list[str]:
+        connection = self.write_transaction()
+        try:
+            groups = [row[0] for row in connection.execute(SQL_LIST_GROUPS)]
+            connection.execute(SQL_DELETE_GROUPS)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return groups
+
+    def import_state(self, state: dict):
+        # Copies a JSON server config (snapshot and journal already merged) in one transaction
+        connection = self.write_transaction()
+        try:
+            connection.execute(SQL_DELETE_GROUPS)
+            for group, group_data in state["groups"].items():
+                group_versions = state["versions"][group]
+                connection.execute(
+                    SQL_INSERT_GROUP,
+                    (group, group_versions["created"], group_versions["version"]),
+                )
+                connection.executemany(
+                    SQL_PUT_MEMBER,
+                    [
+                        (
+                            group,
+                            member,
+                            encode_mods(mods),
+                            group_versions["members"].get(
+                                member, group_versions["version"]
+                            ),
+                        )
+                        for member, mods in group_data.items()
+                    ],
+                )
+            connection.execute(
+                "UPDATE meta SET value = MAX(value, ?) WHERE key = 'version'",
+                (state["version"],),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
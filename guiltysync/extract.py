@@ -0,0 +1,116 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from pathlib import Path, PurePosixPath
+import shutil
+import zipfile
+
+import patoolib
+
+try:
+    import py7zr
+except ImportError:  # Optional dependency, fall back to patoolib
+    py7zr = None
+
+try:
+    import rarfile
+except ImportError:  # Optional dependency, fall back to patoolib
+    rarfile = None
+
+
+# Only the files the game loads are extracted, not readmes, previews etc.
+PAYLOAD_SUFFIXES = (".pak", ".sig", ".utoc", ".ucas")
+EXTRACT_DIRNAME = ".extract"
+
+ARCHIVE_ERRORS = (zipfile.BadZipFile,)
+if py7zr is not None:
+    ARCHIVE_ERRORS += (py7zr.exceptions.ArchiveError, py7zr.exceptions.PasswordRequired)
+if rarfile is not None:
+    ARCHIVE_ERRORS += (rarfile.Error,)
+
+
+def is_payload(member_name: str) -> bool:
+    return PurePosixPath(member_name).suffix.lower() in PAYLOAD_SUFFIXES
+
+
+def extract_zip(archive_filepath: Path, target_dir: Path) -> list[Path]:
+    with zipfile.ZipFile(archive_filepath) as archive:
+        return [
+            Path(archive.extract(member, target_dir))
+            for member in archive.infolist()
+            if not member.is_dir() and is_payload(member.filename)
+        ]
+
+
+def extract_7z(archive_filepath: Path, target_dir: Path) -> list[Path]:
+    with py7zr.SevenZipFile(archive_filepath) as archive:
+        members = [name for name in archive.getnames() if is_payload(name)]
+        if members:
+            archive.extract(path=target_dir, targets=members)
+    return [target_dir / Path(name) for name in members]
+
+
+def extract_rar(archive_filepath: Path, target_dir: Path) -> list[Path]:
+    with rarfile.RarFile(archive_filepath) as archive:
+        return [
+            Path(archive.extract(member, target_dir))
+            for member in archive.infolist()
+            if not member.is_dir() and is_payload(member.filename)
+        ]
+
+
+def extract_other(archive_filepath: Path, target_dir: Path) -> list[Path]:
+    # External tools extract everything, so only the payload is moved into place
+    extract_dir = target_dir / EXTRACT_DIRNAME
+    shutil.rmtree(extract_dir, ignore_errors=True)
+    extract_dir.mkdir()
+    try:
+        patoolib.extract_archive(
+            archive_filepath.as_posix(), outdir=extract_dir.as_posix(), verbosity=0
+        )
+        files = []
+        for file_ in extract_dir.glob("**/*"):
+            if file_.is_file() and is_payload(file_.name):
+                target_filepath = target_dir / file_.relative_to(extract_dir)
+                target_filepath.parent.mkdir(parents=True, exist_ok=True)
+                file_.replace(target_filepath)
+                files.append(target_filepath)
+        return files
+    finally:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+
+def extract_payload(archive_filepath: Path, target_dir: Path) -> list[Path]:
+    """
+    Extracts the game files from an archive into target_dir, without unpacking
+    anything else, and returns their paths
+
+    zip archives (and 7z / rar archives, when py7zr / rarfile are installed) are
+    read in-process, everything else (including what those can't read) goes
+    through patoolib. Runs in a worker process when several archives are being
+    extracted, so it only uses its arguments
+    """
+    if zipfile.is_zipfile(archive_filepath):
+        return extract_zip(archive_filepath, target_dir)
+    if py7zr is not None and py7zr.is_7zfile(archive_filepath):
+        try:
+            return extract_7z(archive_filepath, target_dir)
+        except (py7zr.exceptions.ArchiveError, py7zr.exceptions.PasswordRequired):
+            pass  # Compression methods (e.g. BCJ2) or encryption py7zr can't handle
+    if rarfile is not None and rarfile.is_rarfile(archive_filepath):
+        try:
+            return extract_rar(archive_filepath, target_dir)
+        except rarfile.RarCannotExec:  # No unrar tool, patoolib may have another one
+            pass
+    return extract_other(archive_filepath, target_dir)
@@ -0,0 +1,71 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from collections.abc import Callable, Iterable
+import hashlib
+import json
+import mmap
+import os
+from pathlib import Path
+
+
+# hashlib releases the GIL for large updates, so files can be hashed in parallel threads
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def hash_file(filepath: Path, algorithm: str = "sha256", **params) -> str:
+    # params are passed on to hashlib, for example digest_size for blake2b
+    digest = hashlib.new(algorithm, **params)
+    with open(filepath, "rb") as file_:
+        if os.fstat(file_.fileno()).st_size == 0:
+            return digest.hexdigest()  # Empty files can't be mapped
+        with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, len(view), HASH_CHUNK_SIZE):
+                    digest.update(view[offset : offset + HASH_CHUNK_SIZE])
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+def write_json(filepath: Path, data, fsync: bool = False):
+    # Written next to the target and moved over it, so readers never see half a file.
+    # With fsync, the new file is also on disk before it replaces the old one
+    temp_filepath = filepath.with_name(f"{filepath.name}.tmp")
+    with open(temp_filepath, "w", encoding="UTF-8") as json_file:
+        json.dump(data, json_file)
+        if fsync:
+            json_file.flush()
+            os.fsync(json_file.fileno())
+    os.replace(temp_filepath, filepath)
+
+
+def evict_lru(
+    entries: Iterable[tuple[float, int, str]],
+    budget: int,
+    remove: Callable[[str], None],
+    keep: str | None = None,
+):
+    # entries are (last used, size, key). The least recently used are removed
+    # until the rest fit in the budget, except for `keep`
+    entries = sorted(entries, key=lambda entry: entry[0])
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, key in entries:
+        if total_size <= budget:
+            break
+        if key == keep:
+            continue
+        remove(key)
+        total_size -= size
@@ -0,0 +1,146 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath
+
+import requests
+
+import guiltysync
+from guiltysync import MOD_CATEGORIES
+from guiltysync.cache import MetadataCache
+
+
+SEARCH_PARAMS = {
+    "_nPage": 1,
+    "_nPerPage": 10,
+    "sOrder": "best_match",
+    "idGameRow": "11534",
+    "_csvFields": "name,owner",
+}
+
+LOOKUP_ERRORS = (guiltysync.ModNotFound, requests.exceptions.RequestException)
+
+
+def normalize_filename(filename: str) -> str:
+    # Archive names often drop or change separators compared to the pak inside
+    stem = PurePosixPath(filename).name.split(".")[0]
+    return "".join(char for char in stem.lower() if char.isalnum())
+
+
+def matching_downloads(pak_stem: str, downloads: list[dict]) -> list[dict]:
+    target = normalize_filename(pak_stem)
+    return [
+        download
+        for download in downloads
+        if normalize_filename(download["_sFile"]) == target
+    ]
+
+
+class Identification:
+    def __init__(self, filename: str):
+        self.filename = filename
+        # (search record, profile) pairs, best search match first
+        self.candidates: list[tuple[dict, dict]] = []
+        # Set when a single download of a single candidate matches the pak's name
+        self.match: tuple[dict, dict, dict] | None = None
+
+    def best_guess(self) -> tuple[dict, dict] | None:
+        return self.candidates[0] if self.candidates else None
+
+
+def search(search_string: str, mod_category: str, cache: MetadataCache | None):
+    return guiltysync.cached_api_get(
+        cache,
+        MetadataCache.search_key(mod_category, search_string),
+        "https://gamebanana.com/apiv10/Util/Search/Results",
+        params={
+            **SEARCH_PARAMS,
+            "_sModelName": mod_category,
+            "_sSearchString": search_string,
+        },
+    )["_aRecords"]
+
+
+def identify_mods(
+    filenames: list[str],
+    *,
+    cache: MetadataCache | None = None,
+    workers: int = 8,
+    max_candidates: int = 5,
+) -> dict[str, Identification]:
+    """
+    Looks up every filename on GameBanana at once, without prompting
+
+    All searches are issued concurrently, then the profiles of the top results
+    are fetched concurrently. A mod is only matched outright when exactly one
+    download of one candidate has the same name as the pak
+    """
+    results = {filename: Identification(filename) for filename in filenames}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        searches = {
+            (filename, mod_category): executor.submit(
+                search, filename, mod_category, cache
+            )
+            for filename in filenames
+            for mod_category in MOD_CATEGORIES
+        }
+
+        records = {}
+        for filename in filenames:
+            ranked = []
+            for mod_category in MOD_CATEGORIES:
+                try:
+                    found = searches[(filename, mod_category)].result()
+                except LOOKUP_ERRORS:
+                    continue
+                ranked.extend(enumerate(found))
+            # Interleave the categories so both of their best matches are considered
+            ranked.sort(key=lambda item: item[0])
+            records[filename] = [record for _, record in ranked[:max_candidates]]
+
+        profiles = {}
+        for found in records.values():
+            for record in found:
+                profile_key = (record["_sModelName"], record["_idRow"])
+                if profile_key not in profiles:
+                    profiles[profile_key] = executor.submit(
+                        guiltysync.get_mod_details,
+                        record["_idRow"],
+                        record["_sModelName"],
+                        cache,
+                    )
+
+        for filename, found in records.items():
+            identification = results[filename]
+            matches = []
+            for record in found:
+                try:
+                    details = profiles[
+                        (record["_sModelName"], record["_idRow"])
+                    ].result()
+                except LOOKUP_ERRORS:
+                    continue
+                identification.candidates.append((record, details))
+                matches.extend(
+                    (record, details, download)
+                    for download in matching_downloads(
+                        filename, details.get("_aFiles") or []
+                    )
+                )
+            if len(matches) == 1:
+                identification.match = matches[0]
+
+    return results
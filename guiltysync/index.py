@@ -0,0 +1,229 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+
+from guiltysync.fileutil import hash_file, write_json
+
+
+INDEX_VERSION = 2
+MOD_SUFFIXES = (".pak", ".sig", ".id")
+def hash_pak(filepath: Path) -> str:
+    return hash_file(filepath, "blake2b", digest_size=20)
+
+
+class ModIndex:
+    """
+    Persistent index of the mod files under the shared folder
+
+    A directory is only listed again when its mtime changes, and an .id file
+    (or the content hash of a .pak) is only read again when its size or mtime
+    changes. Content hashes of mods that have been identified before, locally or
+    by other group members, are remembered so the same pak can be recognised later
+    """
+
+    def __init__(self, index_filepath: Path, root: Path, read_only: bool = False):
+        self.index_filepath = index_filepath
+        self.root = root
+        self.read_only = read_only
+        self.dirty = False
+
+        try:
+            with open(self.index_filepath, "r", encoding="UTF-8") as index_file:
+                self.index = json.load(index_file)
+        except (OSError, json.JSONDecodeError):
+            self.index = None
+
+        if (
+            self.index is None
+            or self.index.get("version") != INDEX_VERSION
+            or self.index.get("root") != self.root.as_posix()
+        ):
+            self.rebuild()
+
+    def rebuild(self):
+        # Hashes of identified mods don't depend on the files that are present
+        known = self.index.get("known", {}) if isinstance(self.index, dict) else {}
+        self.index = {
+            "version": INDEX_VERSION,
+            "root": self.root.as_posix(),
+            "dirs": {},
+            "ids": {},
+            "hashes": {},
+            "known": known,
+        }
+        self.dirty = True
+
+    def write(self):
+        if not self.dirty or self.read_only:
+            return
+        write_json(self.index_filepath, self.index)
+        self.dirty = False
+
+    def list_dir(self, relative_dir: str) -> dict:
+        dir_path = self.root / Path(relative_dir)
+        mtime = os.stat(dir_path).st_mtime_ns
+
+        cached = self.index["dirs"].get(relative_dir)
+        if cached is not None and cached["mtime"] == mtime:
+            return cached
+
+        listing = {"mtime": mtime, "files": [], "subdirs": []}
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    listing["subdirs"].append(entry.name)
+                elif entry.name.endswith(MOD_SUFFIXES):
+                    listing["files"].append(entry.name)
+
+        self.index["dirs"][relative_dir] = listing
+        self.dirty = True
+        return listing
+
+    def read_id(self, relative_filepath: str) -> dict:
+        stat = os.stat(self.root / Path(relative_filepath))
+
+        cached = self.index["ids"].get(relative_filepath)
+        if (
+            cached is not None
+            and cached["size"] == stat.st_size
+            and cached["mtime"] == stat.st_mtime_ns
+        ):
+            return cached["data"]
+
+        with open(
+            self.root / Path(relative_filepath), "r", encoding="UTF-8"
+        ) as id_file:
+            id_data = json.load(id_file)
+
+        self.index["ids"][relative_filepath] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "data": id_data,
+        }
+        self.dirty = True
+        return id_data
+
+    def hash_paks(self, filepaths: list[Path], workers: int = 4) -> dict[Path, str]:
+        # Takes the resolved paths returned by scan(), and forgets every other pak
+        resolved_root = self.root.resolve()
+        hashes = {}
+        pending = {}
+        seen = set()
+        for filepath in filepaths:
+            relative_filepath = filepath.relative_to(resolved_root).as_posix()
+            seen.add(relative_filepath)
+            stat = os.stat(filepath)
+            cached = self.index["hashes"].get(relative_filepath)
+            if (
+                cached is not None
+                and cached["size"] == stat.st_size
+                and cached["mtime"] == stat.st_mtime_ns
+            ):
+                hashes[filepath] = cached["hash"]
+            else:
+                pending[filepath] = (relative_filepath, stat)
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for filepath, pak_hash in zip(pending, executor.map(hash_pak, pending)):
+                    relative_filepath, stat = pending[filepath]
+                    self.index["hashes"][relative_filepath] = {
+                        "size": stat.st_size,
+                        "mtime": stat.st_mtime_ns,
+                        "hash": pak_hash,
+                    }
+                    hashes[filepath] = pak_hash
+            self.dirty = True
+
+        for stale_hash in self.index["hashes"].keys() - seen:
+            del self.index["hashes"][stale_hash]
+            self.dirty = True
+
+        self.write()
+
+        return hashes
+
+    def remember(self, pak_hash: str, id_data: dict):
+        if self.index["known"].get(pak_hash) != id_data:
+            self.index["known"][pak_hash] = id_data
+            self.dirty = True
+
+    def recognise(self, pak_hash: str) -> dict | None:
+        return self.index["known"].get(pak_hash)
+
+    def snapshot(self) -> frozenset:
+        # Paks are compared by size and mtime too, since one replaced under the same
+        # name keeps its path but gets a new hash
+        entries = set()
+        for file_, _, id_data in self.scan():
+            stat = None
+            if file_.suffix == ".pak":
+                try:
+                    file_stat = file_.stat()
+                    stat = (file_stat.st_size, file_stat.st_mtime_ns)
+                except FileNotFoundError:  # Removed since the scan
+                    continue
+            entries.add((file_.as_posix(), json.dumps(id_data, sort_keys=True), stat))
+        return frozenset(entries)
+
+    def scan(self) -> list[tuple[Path, str, dict | None]]:
+        # Returns (path, top-level folder under root, parsed .id data) for every mod file
+        files = []
+        seen_dirs = set()
+        seen_ids = set()
+
+        resolved_root = self.root.resolve()
+        pending = ["."]
+        while pending:
+            relative_dir = pending.pop()
+            try:
+                listing = self.list_dir(relative_dir)
+            except FileNotFoundError:  # Removed while scanning
+                continue
+            seen_dirs.add(relative_dir)
+
+            relative_path = Path(relative_dir)
+            top_level = relative_path.parts[0] if relative_path.parts else ""
+            for name in listing["files"]:
+                relative_filepath = (relative_path / Path(name)).as_posix()
+                id_data = None
+                if name.endswith(".id"):
+                    try:
+                        id_data = self.read_id(relative_filepath)
+                    except FileNotFoundError:
+                        continue
+                    seen_ids.add(relative_filepath)
+                files.append(
+                    (resolved_root / relative_path / Path(name), top_level, id_data)
+                )
+
+            pending.extend(
+                (relative_path / Path(subdir)).as_posix()
+                for subdir in listing["subdirs"]
+            )
+
+        for stale_dir in self.index["dirs"].keys() - seen_dirs:
+            del self.index["dirs"][stale_dir]
+            self.dirty = True
+        for stale_id in self.index["ids"].keys() - seen_ids:
+            del self.index["ids"][stale_id]
+            self.dirty = True
+
+        self.write()
+
+        return files
@@ -0,0 +1,158 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+HAVE = "have"
+UPDATE = "update"
+NEED = "need"
+# Another member's download of a mod, when the conflict policy picked a different one
+OTHER = "other"
+
+# How to pick between members sharing different downloads of the same mod
+NEWEST = "newest"
+MAJORITY = "majority"
+CONFLICT_POLICIES = (NEWEST, MAJORITY)
+
+
+def index_group(group_data: dict) -> dict:
+    # mod ID -> download ID -> {"owners": [nicknames], "data": mod data}
+    group_index = {}
+    for nick, mods in group_data.items():
+        for mod_id, mod_data in mods.items():
+            download = group_index.setdefault(mod_id, {}).setdefault(
+                mod_data["download_id"], {"owners": [], "data": mod_data}
+            )
+            download["owners"].append(nick)
+    return group_index
+
+
+def download_order(download_id) -> tuple[int, str]:
+    # GameBanana file IDs increase over time, so a higher ID is a newer upload
+    download_id = str(download_id)
+    return (int(download_id) if download_id.isdigit() else -1, download_id)
+
+
+def choose_download(
+    downloads: dict, policy: str = NEWEST, pinned_members: list[str] | None = None
+) -> dict:
+    """
+    Picks which of the group's downloads of a mod everyone should have
+
+    A download shared by a pinned member wins (earlier members first), otherwise
+    the newest one, or the one the most members share with the majority policy.
+    Remaining ties go to the newest download, so every member makes the same choice
+    no matter what order the group was listed in
+    """
+    pinned_members = pinned_members or []
+
+    def rank(download):
+        pin = min(
+            (
+                pinned_members.index(owner)
+                for owner in download["owners"]
+                if owner in pinned_members
+            ),
+            default=len(pinned_members),
+        )
+        votes = len(download["owners"]) if policy == MAJORITY else 0
+        return (-pin, votes, download_order(download["data"]["download_id"]))
+
+    return max(downloads.values(), key=rank)
+
+
+class SyncPlan:
+    """
+    What needs to happen to bring the local mods in line with a group
+
+    The group is indexed once by mod ID, then compared against the local mods:
+    other members' mods that are missing go in `to_download`, ones we have a
+    different download of go in `to_update`, and downloaded (external) mods that
+    nobody shares anymore go in `to_prune`, with the rest in `to_keep`. All of
+    them map mod ID -> mod data (the group's for downloads / updates, the local
+    one for prunes / keeps)
+
+    When members share different downloads of a mod, only the one picked by
+    `choose_download` is planned for, so refreshes don't flip between them
+    """
+
+    def __init__(
+        self,
+        group_data: dict,
+        local_mods: dict,
+        nickname: str,
+        *,
+        policy: str = NEWEST,
+        pinned_members: list[str] | None = None,
+    ):
+        self.group_index = index_group(group_data)
+        self.local_mods = local_mods
+        self.local_downloads = {
+            (mod_id, mod_info["chosen_download"])
+            for mod_id, mod_info in local_mods.items()
+        }
+        self.local_hashes = {
+            mod_info["hash"] for mod_info in local_mods.values() if mod_info.get("hash")
+        }
+
+        # mod ID -> the download ID everyone should end up with
+        self.chosen = {}
+        self.to_download = {}
+        self.to_update = {}
+        for mod_id, downloads in self.group_index.items():
+            download = choose_download(downloads, policy, pinned_members)
+            self.chosen[mod_id] = download["data"]["download_id"]
+            if download["owners"] == [nickname]:
+                continue  # Only ours
+            status = self.mod_status(
+                mod_id,
+                download["data"]["download_id"],
+                download["data"].get("hash"),
+            )
+            if status == UPDATE:
+                self.to_update[mod_id] = download["data"]
+            elif status == NEED:
+                self.to_download[mod_id] = download["data"]
+
+        group_hashes = {
+            download["data"]["hash"]
+            for downloads in self.group_index.values()
+            for download in downloads.values()
+            if download["data"].get("hash")
+        }
+
+        self.to_prune = {}
+        self.to_keep = {}
+        for mod_id, mod_info in local_mods.items():
+            if not mod_info["external"]:
+                continue
+            # Mods that someone shares a different download of are kept until the
+            # update replaces them, so a failed update doesn't lose the mod. Mods
+            # with the same pak as one in the group stand in for it (see mod_status)
+            if mod_id in self.group_index or mod_info.get("hash") in group_hashes:
+                self.to_keep[mod_id] = mod_info
+            else:
+                self.to_prune[mod_id] = mod_info
+
+    def mod_status(
+        self, mod_id: str, download_id: str, content_hash: str | None = None
+    ) -> str:
+        # A re-upload of the same pak, or the same pak under another mod, needs no download
+        if (mod_id, download_id) in self.local_downloads or (
+            content_hash is not None and content_hash in self.local_hashes
+        ):
+            return HAVE
+        if self.chosen.get(mod_id, download_id) != download_id:
+            return OTHER
+        if mod_id in self.local_mods:
+            return UPDATE
+        return NEED
@@ -0,0 +1,135 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+import os
+from pathlib import Path
+import shutil
+import threading
+import time
+
+from guiltysync.fileutil import evict_lru, hash_file, write_json
+
+
+def link_or_copy(source: Path, target: Path):
+    try:
+        os.link(source, target)
+    except OSError:  # Different filesystem, or links are not supported
+        shutil.copy2(source, target)
+
+
+class ModStore:
+    """
+    Extracted mod files, keyed by GameBanana download ID and archive hash
+
+    Lives outside of ~mods so that mods which are pruned from .external (for example
+    when switching groups) can be put back without downloading them again
+    """
+
+    def __init__(self, root: Path, budget: int):
+        self.root = root
+        self.budget = budget
+        self.index_filepath = root / "index.json"
+        # Mods are downloaded and extracted here before being moved into ~mods
+        self.staging_dir = root / "staging"
+        self.lock = threading.Lock()
+
+        try:
+            with open(self.index_filepath, "r", encoding="UTF-8") as index_file:
+                self.index = json.load(index_file)
+        except (OSError, json.JSONDecodeError):
+            self.index = {"entries": {}, "downloads": {}}
+
+    def write_index(self):
+        write_json(self.index_filepath, self.index)
+
+    def entry_dir(self, key: str) -> Path:
+        return self.root / Path(key)
+
+    def get(self, download_id: str) -> str | None:
+        with self.lock:
+            key = self.index["downloads"].get(download_id)
+            if key is None:
+                return None
+            if not self.entry_dir(key).exists():
+                self.remove(key)
+                self.write_index()
+                return None
+            self.index["entries"][key]["last_used"] = time.time()
+            self.write_index()
+            return key
+
+    def peek(self, download_id: str) -> dict | None:
+        # Like get(), but doesn't count as a use
+        with self.lock:
+            key = self.index["downloads"].get(download_id)
+            if key is None or not self.entry_dir(key).exists():
+                return None
+            return self.index["entries"][key]
+
+    def add(self, download_id: str, archive_filepath: Path, extracted_dir: Path, files):
+        key = f"{download_id}-{hash_file(archive_filepath)}"
+        entry_dir = self.entry_dir(key)
+
+        with self.lock:
+            if key not in self.index["entries"]:
+                size = 0
+                for file_ in files:
+                    relative_filepath = file_.relative_to(extracted_dir)
+                    (entry_dir / relative_filepath).parent.mkdir(
+                        parents=True, exist_ok=True
+                    )
+                    link_or_copy(file_, entry_dir / relative_filepath)
+                    size += file_.stat().st_size
+
+                self.index["entries"][key] = {
+                    "download_id": download_id,
+                    "size": size,
+                    "files": [
+                        file_.relative_to(extracted_dir).as_posix() for file_ in files
+                    ],
+                    "last_used": time.time(),
+                }
+            self.index["downloads"][download_id] = key
+            self.evict(keep=key)
+            self.write_index()
+
+        return key
+
+    def materialize(self, key: str, target_dir: Path):
+        entry_dir = self.entry_dir(key)
+        for relative_filepath in self.index["entries"][key]["files"]:
+            target_filepath = target_dir / Path(relative_filepath)
+            target_filepath.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(entry_dir / Path(relative_filepath), target_filepath)
+
+    def remove(self, key: str):
+        entry = self.index["entries"].pop(key, None)
+        if (
+            entry is not None
+            and self.index["downloads"].get(entry["download_id"]) == key
+        ):
+            del self.index["downloads"][entry["download_id"]]
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+
+    def evict(self, keep: str | None = None):
+        evict_lru(
+            [
+                (entry["last_used"], entry["size"], key)
+                for key, entry in self.index["entries"].items()
+            ],
+            self.budget,
+            self.remove,
+            keep=keep,
+        )
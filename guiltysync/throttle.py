@@ -0,0 +1,147 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from pathlib import Path
+import subprocess
+import sys
+import threading
+import time
+
+import click
+
+
+# strive.exe is the original launcher (see the README), which starts the actual game
+GAME_PROCESSES = ("strive.exe", "ggst-win64-shipping.exe")
+
+
+def game_running() -> bool:
+    if sys.platform == "win32":
+        try:
+            res = subprocess.run(
+                ["tasklist", "/FO", "CSV", "/NH"], capture_output=True, text=True
+            )
+        except OSError:
+            return False
+        processes = res.stdout.lower()
+        return any(f'"{name}"' in processes for name in GAME_PROCESSES)
+
+    # Under Proton / Wine the Windows executable shows up in the command line
+    for cmdline_filepath in Path("/proc").glob("[0-9]*/cmdline"):
+        try:
+            cmdline = cmdline_filepath.read_bytes().lower()
+        except OSError:  # Exited, or not ours to read
+            continue
+        if any(name.encode() in cmdline for name in GAME_PROCESSES):
+            return True
+    return False
+
+
+class ThrottledReader:
+    # File wrapper for uploads, which requests streams through read()
+    def __init__(self, file_, size: int, throttle: "DownloadThrottle"):
+        self.file = file_
+        self.size = size
+        self.throttle = throttle
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(lambda: self.read(64 * 1024), b"")
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.file.read(size)
+        self.throttle.consume(len(chunk))
+        return chunk
+
+
+class DownloadThrottle:
+    """
+    Shared by all of a client's transfers, to cap their combined speed at `rate`
+    bytes per second (unlimited if None) and to hold them while the game runs
+
+    The rate is enforced with a token bucket that can go into debt: each transfer
+    takes what it just read and sleeps until the bucket is back in credit, so the
+    total speed stays under the limit however many downloads run at once
+    """
+
+    def __init__(
+        self,
+        rate: int | None = None,
+        *,
+        pause_while_playing: bool = True,
+        check_interval: float = 5.0,
+    ):
+        self.rate = rate
+        self.pause_while_playing = pause_while_playing
+        self.check_interval = check_interval
+        # Counts pauses, so transfers can tell if one happened while they ran
+        self.pauses = 0
+        self.paused_seconds = 0.0
+
+        self.lock = threading.Lock()
+        self.tokens = float(rate or 0)
+        self.updated = time.monotonic()
+        self.checked = None
+        self.resumed = threading.Event()
+        self.resumed.set()
+
+    def consume(self, size: int):
+        self.wait_for_game()
+        if self.rate is None:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            # At most a second's worth of transfer can be saved up
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def wait_for_game(self):
+        if not self.pause_while_playing:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            # One transfer looks for the game at a time, the others wait for it
+            check = self.resumed.is_set() and (
+                self.checked is None or now - self.checked >= self.check_interval
+            )
+            if check:
+                self.checked = now
+                self.resumed.clear()
+
+        if not check:
+            self.resumed.wait()
+            return
+
+        try:
+            if game_running():
+                pause_start = time.monotonic()
+                click.echo("Guilty Gear Strive is running, pausing downloads...")
+                while game_running():
+                    time.sleep(self.check_interval)
+                click.echo("Resuming downloads")
+                with self.lock:
+                    self.pauses += 1
+                    self.paused_seconds += time.monotonic() - pause_start
+                    # Nothing is saved up during the pause
+                    self.tokens = min(self.tokens, 0)
+                    self.updated = time.monotonic()
+        finally:
+            self.resumed.set()
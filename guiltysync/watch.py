@@ -0,0 +1,163 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from collections.abc import Callable
+from pathlib import Path
+import queue
+import threading
+import time
+
+import requests
+
+import guiltysync.transport as transport
+from guiltysync.wire import COMPACT_FORMAT, read_changes
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # Optional dependency, fall back to polling
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class ChangeHandler(FileSystemEventHandler):  # type: ignore
+    def __init__(self, changed: threading.Event):
+        super().__init__()
+        self.changed = changed
+
+    def on_any_event(self, event):
+        self.changed.set()
+
+
+class ChangeWatcher:
+    """
+    Waits for changes under a folder, using OS file notifications (inotify etc.)
+    when watchdog is installed and polling `snapshot_fn` otherwise
+
+    Bursts of changes are debounced into a single wakeup
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        snapshot_fn: Callable,
+        *,
+        debounce: float = 2.0,
+        poll_interval: float = 5.0,
+    ):
+        self.root = root
+        self.snapshot_fn = snapshot_fn
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.changed = threading.Event()
+        self.observer = None
+
+    @property
+    def uses_notifications(self) -> bool:
+        return Observer is not None
+
+    def start(self):
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(
+                ChangeHandler(self.changed), self.root.as_posix(), recursive=True
+            )
+            self.observer.start()
+        self.snapshot = self.snapshot_fn()
+        self.next_poll = time.monotonic() + self.poll_interval
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        # Returns True once a burst of changes has settled, False on timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        if self.observer is not None:
+            if not self.changed.wait(timeout):
+                return False
+            self.changed.clear()
+            while self.changed.wait(self.debounce):
+                self.changed.clear()
+            self.snapshot = self.snapshot_fn()
+            return True
+
+        while True:
+            wake_at = self.next_poll
+            if deadline is not None:
+                wake_at = min(wake_at, deadline)
+            time.sleep(max(0, wake_at - time.monotonic()))
+
+            if time.monotonic() >= self.next_poll:
+                self.next_poll = time.monotonic() + self.poll_interval
+                snapshot = self.snapshot_fn()
+                if snapshot != self.snapshot:
+                    while True:
+                        time.sleep(self.debounce)
+                        settled_snapshot = self.snapshot_fn()
+                        if settled_snapshot == snapshot:
+                            break
+                        snapshot = settled_snapshot
+                    self.snapshot = snapshot
+                    return True
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+
+class GroupFollower(threading.Thread):
+    """
+    Long-polls the sync server's event feed for a group and queues each batch
+    of member changes for the main thread
+    """
+
+    def __init__(self, server: str, group_name: str, since: int, poll_timeout=30):
+        super().__init__(daemon=True)
+        self.server = server
+        self.group_name = group_name
+        self.since = since
+        self.poll_timeout = poll_timeout
+        self.changes = queue.Queue()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        retry_delay = 1
+        while not self.stopped.is_set():
+            try:
+                res = transport.get(
+                    f"{self.server}/groups/{self.group_name}/events",
+                    params={
+                        "since": self.since,
+                        "timeout": self.poll_timeout,
+                        "format": COMPACT_FORMAT,
+                    },
+                    timeout=(5, self.poll_timeout + 10),
+                )
+                res.raise_for_status()
+            except requests.exceptions.RequestException:
+                self.stopped.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+                continue
+            retry_delay = 1
+
+            if res.status_code == 304:
+                continue
+            changes = read_changes(res)
+            self.since = changes["version"]
+            self.changes.put(changes)
@@ -0,0 +1,70 @@
+"""
+guiltysync - Sync Guilty Gear Strive mods
+    Copyright (C) 2023  Michael Manis - michaelmanis@tutanota.com
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+
+import requests
+
+
+# Group documents are sent in the compact format when the client asks for it with
+# ?format=compact and the server supports it, which the server marks with this header
+FORMAT_HEADER = "X-GuiltySync-Format"
+COMPACT_FORMAT = "compact"
+
+
+def compact_members(members: dict) -> dict:
+    # member -> mod ID -> mod data becomes a table of distinct (mod ID, mod data)
+    # pairs, plus member -> indices into that table
+    mods = []
+    mod_indices = {}
+    compact = {}
+    for member, member_mods in members.items():
+        indices = []
+        for mod_id, mod_data in member_mods.items():
+            key = json.dumps([mod_id, mod_data], sort_keys=True)
+            index = mod_indices.get(key)
+            if index is None:
+                index = mod_indices[key] = len(mods)
+                mods.append([mod_id, mod_data])
+            indices.append(index)
+        compact[member] = indices
+    return {"mods": mods, "members": compact}
+
+
+def expand_members(compact: dict) -> dict:
+    mods = compact["mods"]
+    return {
+        member: {mods[index][0]: dict(mods[index][1]) for index in indices}
+        for member, indices in compact["members"].items()
+    }
+
+
+def compact_changes(changes: dict) -> dict:
+    return {**changes, "members": compact_members(changes["members"])}
+
+
+def is_compact(res: requests.Response) -> bool:
+    return res.headers.get(FORMAT_HEADER) == COMPACT_FORMAT
+
+
+def read_group(res: requests.Response) -> dict:
+    group_data = res.json()
+    return expand_members(group_data) if is_compact(res) else group_data
+
+
+def read_changes(res: requests.Response) -> dict:
+    changes = res.json()
+    if is_compact(res):
+        changes["members"] = expand_members(changes["members"])
+    return changes
@@ -21,7 +21,12 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=["Click", "requests", "fastapi", "uvicorn", "patool", "packaging"],
-    extras_require={"exe": ["pyinstaller"], "dev": ["black"]},
+    extras_require={
+        "exe": ["pyinstaller"],
+        "dev": ["black"],
+        "watch": ["watchdog"],
+        "archives": ["py7zr", "rarfile"],
+    },
     entry_points={
         "console_scripts": [
             "guiltysync = guiltysync.cli:cli",
@@ -12,17 +12,51 @@ guiltysync - Sync Guilty Gear Strive mods
     You should have received a copy of the GNU Affero General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import asyncio
+from contextlib import contextmanager
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import importlib
+import io
+import json
 from pathlib import Path
+import threading
+import zipfile
 
+import click
 from click.testing import CliRunner
+from fastapi import HTTPException
 import requests
 
-from guiltysync.cli import cli
+import guiltysync
+from guiltysync.cache import MetadataCache
+from guiltysync.cli import SyncClient, cli
+from guiltysync.cli.blobs import BlobExists, BlobStore
+from guiltysync.cli.journal import Journal
+from guiltysync.cli.storage import JsonStorage, SqliteStorage
+from guiltysync.fileutil import evict_lru, hash_file, write_json
+from guiltysync.index import ModIndex
+from guiltysync.plan import HAVE, MAJORITY, NEED, OTHER, UPDATE, SyncPlan
+from guiltysync.store import ModStore
+import guiltysync.throttle
+from guiltysync.throttle import DownloadThrottle
+from guiltysync.wire import (
+    COMPACT_FORMAT,
+    FORMAT_HEADER,
+    compact_changes,
+    compact_members,
+    expand_members,
+    read_changes,
+    read_group,
+)
 
 
 GAME_DIR = "/mnt/storage/SteamLibrary/steamapps/common/GUILTY GEAR STRIVE/"
 SERVER = "http://localhost:5000"
 
+# guiltysync.cli.server is shadowed by the `server` command in guiltysync.cli
+server = importlib.import_module("guiltysync.cli.server")
+
 
 def rm_config():
     config_file = Path("guiltysync.json")
@@ -43,6 +77,88 @@ def delete_group(group, allow_404=True):
             raise e
 
 
+@contextmanager
+def serve(routes: dict):
+    # Local HTTP server for download tests. routes maps a path to the bytes to
+    # serve (honouring Range), a status code, ("redirect", path) or ("full", bytes)
+    # to ignore Range. Uploads are recorded as (path, "PUT") and get a 501
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append((self.path, self.headers.get("Range")))
+            route = routes.get(self.path, 404)
+            if isinstance(route, int):
+                self.send_response(route)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            elif isinstance(route, tuple) and route[0] == "full":
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(route[1])))
+                self.end_headers()
+                self.wfile.write(route[1])
+            elif isinstance(route, tuple):
+                self.send_response(302)
+                self.send_header("Location", route[1])
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                start = 0
+                range_ = self.headers.get("Range")
+                if range_ is not None:
+                    start = int(range_.split("=")[1].rstrip("-"))
+                    self.send_response(206)
+                    self.send_header(
+                        "Content-Range", f"bytes {start}-{len(route) - 1}/{len(route)}"
+                    )
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(len(route) - start))
+                self.end_headers()
+                self.wfile.write(route[start:])
+
+        def do_PUT(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            requests_seen.append((self.path.split("?")[0], "PUT"))
+            self.send_response(501)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("localhost", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://localhost:{server.server_address[1]}", requests_seen
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def write_partial(
+    target_dir: Path,
+    url: str,
+    download_url: str,
+    data: bytes,
+    length: int | None = None,
+):
+    (target_dir / "mod.zip.part").write_bytes(data)
+    guiltysync.write_download_state(
+        target_dir,
+        {
+            "download_url": download_url,
+            "url": url,
+            "filename": "mod.zip",
+            "length": length,
+            "etag": None,
+            "last_modified": None,
+            "written": len(data),
+        },
+    )
+
+
 def test_new_group():
     delete_group("test")
     rm_config()
@@ -141,6 +257,747 @@ def test_multiple_users():
     )
 
 
+def test_sync_plan():
+    group_data = {
+        "mike": {"1": {"name": "Mine", "id": "1", "download_id": "10"}},
+        "steve": {
+            "2": {"name": "Have", "id": "2", "download_id": "20"},
+            "3": {"name": "Newer", "id": "3", "download_id": "31"},
+            "4": {"name": "Missing", "id": "4", "download_id": "40"},
+            "5": {"name": "Reupload", "id": "5", "download_id": "51", "hash": "h5"},
+        },
+    }
+    local_mods = {
+        "1": {"chosen_download": "10", "external": False, "hash": "h1"},
+        "2": {"chosen_download": "20", "external": True, "hash": "h2"},
+        "3": {"chosen_download": "30", "external": True, "hash": "h3"},
+        "5": {"chosen_download": "50", "external": True, "hash": "h5"},
+        "6": {"chosen_download": "60", "external": True, "hash": "h6"},
+    }
+
+    plan = SyncPlan(group_data, local_mods, "mike")
+
+    assert plan.to_download == {"4": group_data["steve"]["4"]}
+    assert plan.to_update == {"3": group_data["steve"]["3"]}
+    assert set(plan.to_prune) == {"6"}
+    assert set(plan.to_keep) == {"2", "3", "5"}
+    assert plan.mod_status("5", "51", "h5") == HAVE
+    assert plan.mod_status("3", "31") == UPDATE
+    assert plan.mod_status("4", "40") == NEED
+
+
+def test_sync_plan_shared_download():
+    mod_data = {"name": "Shared", "id": "7", "download_id": "70"}
+    plan = SyncPlan(
+        {"mike": {"7": mod_data}, "steve": {"7": mod_data}},
+        {},
+        "mike",
+    )
+
+    assert plan.group_index["7"]["70"]["owners"] == ["mike", "steve"]
+    assert plan.to_download == {"7": mod_data}
+
+
+def test_sync_plan_keeps_mod_matching_by_hash():
+    group_data = {
+        "steve": {"9": {"name": "Moved", "id": "9", "download_id": "90", "hash": "h"}}
+    }
+    local_mods = {"5": {"chosen_download": "50", "external": True, "hash": "h"}}
+
+    plan = SyncPlan(group_data, local_mods, "mike")
+
+    assert plan.to_download == {}
+    assert plan.to_prune == {}
+    assert set(plan.to_keep) == {"5"}
+
+
+def test_sync_plan_conflicting_downloads():
+    old = {"name": "Conflict", "id": "8", "download_id": "80"}
+    new = {"name": "Conflict", "id": "8", "download_id": "81"}
+    group_data = {"steve": {"8": new}, "bob": {"8": old}, "alice": {"8": old}}
+    local_mods = {"8": {"chosen_download": "80", "external": True}}
+
+    # Same choice whatever order the members are listed in
+    for members in (group_data, dict(reversed(list(group_data.items())))):
+        plan = SyncPlan(members, local_mods, "mike")
+        assert plan.to_update == {"8": new}
+        assert plan.mod_status("8", "80") == HAVE
+
+        plan = SyncPlan(members, local_mods, "mike", policy=MAJORITY)
+        assert plan.to_update == {}
+        assert plan.to_download == {}
+        assert plan.mod_status("8", "81") == OTHER
+
+        plan = SyncPlan(members, {}, "mike", pinned_members=["bob"])
+        assert plan.to_download == {"8": old}
+
+
+def test_read_only_client_changes_nothing(tmp_path):
+    shared_dir = tmp_path / "game" / "RED" / "Content" / "Paks" / "~mods" / "shared"
+    (shared_dir / "known").mkdir(parents=True)
+    (shared_dir / "known" / "known.pak").write_bytes(b"known")
+    (shared_dir / "known" / "known.id").write_text(
+        json.dumps({"id": "1", "name": "Known", "chosen_download": "10"})
+    )
+    (shared_dir / "unknown").mkdir()
+    (shared_dir / "unknown" / "unknown.pak").write_bytes(b"unknown")
+    (shared_dir / "unknown" / "unknown.sig").write_bytes(b"sig")
+    config_filepath = tmp_path / "guiltysync.json"
+    config_filepath.write_text(
+        json.dumps({"version": "0", "groups": {}, "defaults": {}})
+    )
+    files_before = sorted(tmp_path.rglob("*"))
+
+    with serve({"/": b""}) as (url, _):
+        client = SyncClient(
+            "0", config_filepath, tmp_path / "game", url, read_only=True
+        )
+
+    assert set(client.mods) == {"1"}
+    # The missing .sig isn't copied, and no indexes or .id files are written
+    assert sorted(tmp_path.rglob("*")) == files_before
+    assert json.loads(config_filepath.read_text())["defaults"] == {}
+
+
+def test_fetch_archive_resumes_partial_download(tmp_path):
+    archive = bytes(range(256)) * 4
+    with serve({"/file/mod.zip": archive}) as (url, seen):
+        write_partial(
+            tmp_path, f"{url}/file/mod.zip", f"{url}/dl/1", archive[:100], len(archive)
+        )
+
+        archive_filepath = guiltysync.fetch_archive(
+            tmp_path, {"download_id": "1"}, f"{url}/dl/1"
+        )
+
+    assert archive_filepath.read_bytes() == archive
+    assert seen == [("/file/mod.zip", "bytes=100-")]
+    assert not (tmp_path / guiltysync.DOWNLOAD_STATE_FILENAME).exists()
+
+
+def test_fetch_archive_restarts_when_range_is_ignored(tmp_path):
+    archive = b"the whole archive"
+    with serve({"/file/mod.zip": ("full", archive)}) as (url, _):
+        write_partial(tmp_path, f"{url}/file/mod.zip", f"{url}/dl/1", archive[:5])
+
+        archive_filepath = guiltysync.fetch_archive(
+            tmp_path, {"download_id": "1"}, f"{url}/dl/1"
+        )
+
+    assert archive_filepath.read_bytes() == archive
+
+
+def test_fetch_archive_completes_finished_partial(tmp_path):
+    archive = b"already downloaded"
+    with serve({"/file/mod.zip": 416}) as (url, _):
+        write_partial(
+            tmp_path, f"{url}/file/mod.zip", f"{url}/dl/1", archive, len(archive)
+        )
+
+        archive_filepath = guiltysync.fetch_archive(
+            tmp_path, {"download_id": "1"}, f"{url}/dl/1"
+        )
+
+    assert archive_filepath.read_bytes() == archive
+
+
+def test_fetch_archive_keeps_partial_when_relay_fails(tmp_path):
+    archive = bytes(range(256)) * 4
+    with serve({"/blobs/1": 501, "/file/mod.zip": archive}) as (url, seen):
+        write_partial(tmp_path, f"{url}/file/mod.zip", f"{url}/dl/1", archive[:50])
+        mod_data = {"download_id": "1"}
+
+        try:
+            guiltysync.fetch_archive(tmp_path, mod_data, f"{url}/blobs/1")
+            assert False, "The relay should have failed"
+        except requests.exceptions.HTTPError:
+            pass
+        assert (tmp_path / "mod.zip.part").stat().st_size == 50
+
+        archive_filepath = guiltysync.fetch_archive(tmp_path, mod_data, f"{url}/dl/1")
+
+    assert archive_filepath.read_bytes() == archive
+    assert seen[-1] == ("/file/mod.zip", "bytes=50-")
+
+
+def test_fetch_archive_restarts_from_download_page(tmp_path):
+    archive = b"new archive"
+    routes = {
+        "/file/expired/mod.zip": 404,
+        "/dl/1": ("redirect", "/file/new/mod.zip"),
+        "/file/new/mod.zip": archive,
+    }
+    with serve(routes) as (url, seen):
+        write_partial(tmp_path, f"{url}/file/expired/mod.zip", f"{url}/dl/1", b"old")
+
+        archive_filepath = guiltysync.fetch_archive(
+            tmp_path, {"download_id": "1"}, f"{url}/dl/1"
+        )
+
+    assert archive_filepath.read_bytes() == archive
+    assert [path for path, _ in seen] == [
+        "/file/expired/mod.zip",
+        "/dl/1",
+        "/file/new/mod.zip",
+    ]
+
+
+def test_mod_index_snapshot_sees_replaced_pak(tmp_path):
+    shared_dir = tmp_path / "shared"
+    shared_dir.mkdir()
+    pak_filepath = shared_dir / "Mod.pak"
+    pak_filepath.write_bytes(b"old")
+    mod_index = ModIndex(tmp_path / "index.json", shared_dir)
+    before = mod_index.snapshot()
+
+    # Same name and directory, so the folder listing doesn't change
+    pak_filepath.write_bytes(b"new pak")
+
+    assert mod_index.snapshot() != before
+
+
+def test_file_helpers(tmp_path):
+    data = b"mod" * 100000
+    (tmp_path / "mod.pak").write_bytes(data)
+    (tmp_path / "empty.pak").write_bytes(b"")
+    assert hash_file(tmp_path / "mod.pak") == hashlib.sha256(data).hexdigest()
+    assert hash_file(tmp_path / "mod.pak", "md5") == hashlib.md5(data).hexdigest()
+    assert hash_file(tmp_path / "empty.pak", "blake2b", digest_size=20) == (
+        hashlib.blake2b(digest_size=20).hexdigest()
+    )
+
+    write_json(tmp_path / "index.json", {"a": 1})
+    assert json.loads((tmp_path / "index.json").read_text()) == {"a": 1}
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "empty.pak",
+        "index.json",
+        "mod.pak",
+    ]
+
+    removed = []
+    entries = [(3, 10, "newest"), (1, 10, "oldest"), (2, 10, "kept")]
+    evict_lru(entries, 15, removed.append, keep="kept")
+    assert removed == ["oldest", "newest"]
+
+
+def test_blob_store_keeps_first_upload(tmp_path):
+    blob_store = BlobStore(tmp_path, budget=1024, max_size=1024)
+    upload = blob_store.begin_upload(1, 5)
+    upload.write(b"hello")
+    blob_store.finish_upload(upload, 1, "mod.zip")
+
+    try:
+        blob_store.begin_upload(1, 4)
+        assert False, "The first upload should not be replaced"
+    except BlobExists:
+        pass
+
+    object_filepath, blob = blob_store.get(1)
+    assert object_filepath.read_bytes() == b"hello"
+    assert blob["filename"] == "mod.zip"
+
+
+def relay_test_mod(tmp_path: Path, checksummed: bytes):
+    cache = MetadataCache(tmp_path / "cache.json", ttl=3600, budget=1024 * 1024)
+    cache.put(
+        MetadataCache.profile_key("Mod", "5"),
+        {
+            "_aFiles": [
+                {"_idRow": 0, "_sMd5Checksum": hashlib.md5(checksummed).hexdigest()}
+            ]
+        },
+    )
+    target_dir = tmp_path / "target"
+    target_dir.mkdir()
+    return cache, {
+        "5": (target_dir, {"id": "5", "name": "Relayed", "download_id": "0"})
+    }
+
+
+def zip_bytes(files: dict, encrypted: bool = False) -> bytes:
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        for name, data in files.items():
+            zip_file.writestr(name, data)
+    archive = bytearray(archive.getvalue())
+    if encrypted:
+        # Set the encrypted flag in the local and central headers, zipfile then
+        # refuses to extract without a password
+        for signature, flag_offset in ((b"PK\x03\x04", 6), (b"PK\x01\x02", 8)):
+            header = archive.find(signature)
+            while header != -1:
+                archive[header + flag_offset] |= 0x1
+                header = archive.find(signature, header + 1)
+    return bytes(archive)
+
+
+def test_relay_archive_matching_checksum_is_installed(tmp_path):
+    archive = zip_bytes({"Relayed.pak": b"pak", "readme.txt": b"hi"})
+    cache, targets = relay_test_mod(tmp_path, archive)
+    with serve({"/blobs/0": archive}) as (url, _):
+        results = guiltysync.download_mods(targets, relay=f"{url}/blobs", cache=cache)
+
+    assert results == {"5": None}
+    assert (targets["5"][0] / "Relayed.pak").read_bytes() == b"pak"
+
+
+def test_relay_archive_with_wrong_checksum_is_not_installed(tmp_path, monkeypatch):
+    archive = zip_bytes({"Relayed.pak": b"evil"})
+    real_archive = zip_bytes({"Relayed.pak": b"real"})
+    cache, targets = relay_test_mod(tmp_path, real_archive)
+    with serve({"/blobs/0": archive, "/dl/0": real_archive}) as (url, seen):
+        monkeypatch.setattr(
+            guiltysync, "get_download_url", lambda mod_data: f"{url}/dl/0"
+        )
+        results = guiltysync.download_mods(targets, relay=f"{url}/blobs", cache=cache)
+
+    # Falls back to GameBanana
+    assert results == {"5": None}
+    assert [path for path, _ in seen][:2] == ["/blobs/0", "/dl/0"]
+    assert (targets["5"][0] / "Relayed.pak").read_bytes() == b"real"
+
+
+def test_relay_uploads_stop_when_unsupported(tmp_path, monkeypatch):
+    archive = zip_bytes({"Mod.pak": b"pak"})
+    # No checksums, so nothing is downloaded from the relay
+    cache = MetadataCache(tmp_path / "cache.json", ttl=3600, budget=1024 * 1024)
+    targets = {}
+    for mod_id in ("1", "2"):
+        cache.put(
+            MetadataCache.profile_key("Mod", mod_id), {"_aFiles": [{"_idRow": mod_id}]}
+        )
+        (tmp_path / mod_id).mkdir()
+        targets[mod_id] = (
+            tmp_path / mod_id,
+            {"id": mod_id, "name": mod_id, "download_id": mod_id},
+        )
+
+    with serve({"/dl/1": archive, "/dl/2": archive}) as (url, seen):
+        monkeypatch.setattr(
+            guiltysync,
+            "get_download_url",
+            lambda mod_data: f"{url}/dl/{mod_data['download_id']}",
+        )
+        results = guiltysync.download_mods(
+            targets, workers=1, relay=f"{url}/blobs", cache=cache
+        )
+
+    assert results == {"1": None, "2": None}
+    # The first upload's 501 turns the relay off for the rest of the sync
+    assert [request for request in seen if request[1] == "PUT"] == [("/blobs/1", "PUT")]
+
+
+def test_bad_archive_only_fails_its_mod(tmp_path):
+    good = zip_bytes({"Good.pak": b"pak"})
+    targets = {}
+    encrypted = zip_bytes({"Encrypted.pak": b"pak"}, encrypted=True)
+    routes = {"/blobs/0": encrypted, "/blobs/1": good}
+    cache = MetadataCache(tmp_path / "cache.json", ttl=3600, budget=1024 * 1024)
+    for download_id, archive in routes.items():
+        mod_id = download_id[-1]
+        cache.put(
+            MetadataCache.profile_key("Mod", mod_id),
+            {
+                "_aFiles": [
+                    {
+                        "_idRow": mod_id,
+                        "_sMd5Checksum": hashlib.md5(archive).hexdigest(),
+                    }
+                ]
+            },
+        )
+        (tmp_path / mod_id).mkdir()
+        targets[mod_id] = (
+            tmp_path / mod_id,
+            {"id": mod_id, "name": mod_id, "download_id": mod_id},
+        )
+
+    with serve(routes) as (url, _):
+        results = guiltysync.download_mods(targets, relay=f"{url}/blobs", cache=cache)
+
+    assert isinstance(results["0"], click.ClickException)
+    assert results["1"] is None
+
+
+def test_group_locks_are_dropped(tmp_path):
+    server.storage = JsonStorage(tmp_path / "config.json")
+    server.storage.open()
+    user_data = server.UserData(member="mike", mods={})
+
+    async def requests_():
+        await server.post_group("test", user_data)
+        # Concurrent updates share the group's lock while it is held
+        await asyncio.gather(
+            *(server.post_group_member("test", "mike", user_data) for _ in range(3))
+        )
+        try:
+            await server.post_group_member("missing", "mike", user_data)
+            assert False, "The group should not exist"
+        except HTTPException as e:
+            assert e.status_code == 404
+
+    try:
+        asyncio.run(requests_())
+    finally:
+        server.storage.close()
+
+    assert server.group_locks == {}
+
+
+def journal_entry(seq: int, op: str, **fields) -> dict:
+    return {"seq": seq, "op": op, **fields}
+
+
+def write_journal(journal: Journal, lines: list[str]):
+    journal.journal_filepath.write_text("".join(line + "\n" for line in lines))
+
+
+def test_journal_replays_after_crash(tmp_path):
+    storage = JsonStorage(tmp_path / "config.json")
+    storage.open()
+    storage.create_group("test", "mike", {"1": {"name": "Mod"}})
+    storage.put_member("test", "steve", {})
+    # Not closed, as if the server crashed
+
+    recovered = JsonStorage(tmp_path / "config.json")
+    recovered.open()
+    try:
+        assert recovered.get_group("test") == storage.get_group("test")
+    finally:
+        recovered.close()
+        storage.journal.close()
+
+
+def test_journal_skips_entries_in_snapshot(tmp_path):
+    journal = Journal(tmp_path / "config.json")
+    # Crashed after compacting (which deleted the group) but before the journal
+    # was emptied, so the journal still has the entries that created it
+    journal.snapshot_filepath.write_text(
+        json.dumps({"groups": {}, "versions": {}, "version": 2, "journal_seq": 3})
+    )
+    write_journal(
+        journal,
+        [
+            json.dumps(
+                journal_entry(
+                    1, "create_group", group="old", member="a", mods={}, version=1
+                )
+            ),
+            json.dumps(
+                journal_entry(
+                    2, "put_member", group="old", member="b", mods={}, version=2
+                )
+            ),
+            json.dumps(
+                journal_entry(
+                    4, "create_group", group="new", member="a", mods={}, version=3
+                )
+            ),
+        ],
+    )
+
+    state = journal.load()
+
+    assert state["groups"] == {"new": {"a": {}}}
+    assert state["journal_seq"] == 4
+    assert state["version"] == 3
+
+
+def test_journal_stops_at_torn_write(tmp_path):
+    journal = Journal(tmp_path / "config.json")
+    create = journal_entry(
+        1, "create_group", group="test", member="a", mods={}, version=1
+    )
+    put = journal_entry(2, "put_member", group="test", member="b", mods={}, version=2)
+    write_journal(journal, [json.dumps(create), json.dumps(put)[:20]])
+
+    state = journal.load()
+
+    assert state["groups"] == {"test": {"a": {}}}
+    assert state["journal_seq"] == 1
+
+
+def check_group_changes(storage: JsonStorage | SqliteStorage):
+    storage.create_group("test", "mike", {"1": {"name": "Mod"}})
+    created, _ = storage.get_group("test")
+    assert storage.put_member("test", "steve", {"2": {"name": "Other"}})
+    version, _ = storage.get_group("test")
+
+    assert storage.get_group_changes("test", version) == (version, None)
+    assert storage.get_group_changes("test", created) == (
+        version,
+        {
+            "version": version,
+            "full": False,
+            "members": {"steve": {"2": {"name": "Other"}}},
+        },
+    )
+    assert storage.get_group_changes("test", -1)[1]["full"]
+
+    # Unchanged mods keep the version
+    assert not storage.put_member("test", "steve", {"2": {"name": "Other"}})
+    assert storage.get_group("test")[0] == version
+
+    # A copy from before the group was recreated gets all of the new group
+    storage.delete_group("test")
+    storage.create_group("test", "bob", {})
+    recreated, _ = storage.get_group("test")
+    assert recreated > version
+    assert storage.get_group_changes("test", version)[1] == {
+        "version": recreated,
+        "full": True,
+        "members": {"bob": {}},
+    }
+
+
+def test_json_storage_group_changes(tmp_path):
+    storage = JsonStorage(tmp_path / "config.json")
+    storage.open()
+    try:
+        check_group_changes(storage)
+    finally:
+        storage.close()
+
+
+def test_sqlite_storage_group_changes(tmp_path):
+    storage = SqliteStorage(tmp_path / "guiltysync.db")
+    storage.open()
+    try:
+        check_group_changes(storage)
+    finally:
+        storage.close()
+
+
+def test_json_storage_reads_match_their_version(tmp_path):
+    storage = JsonStorage(tmp_path / "config.json")
+    storage.open()
+    storage.create_group("test", "mike", {"n": {"name": "0"}})
+    base, _ = storage.get_group("test")
+    writes = 2000
+
+    def write():
+        for n in range(1, writes + 1):
+            storage.put_member("test", "mike", {"n": {"name": str(n)}})
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    mismatches = 0
+    try:
+        while writer.is_alive():
+            # The only writer bumps the version once per PUT, so the data sent with
+            # a version must be the PUT that produced it
+            version, changes = storage.get_group_changes("test", -1)
+            if changes["members"]["mike"]["n"]["name"] != str(version - base):
+                mismatches += 1
+            version, group_data = storage.get_group("test")
+            if group_data["mike"]["n"]["name"] != str(version - base):
+                mismatches += 1
+    finally:
+        writer.join()
+        storage.close()
+
+    assert mismatches == 0
+
+
+def test_sqlite_import_state(tmp_path):
+    json_storage = JsonStorage(tmp_path / "config.json")
+    json_storage.open()
+    json_storage.create_group("test", "mike", {"1": {"name": "Mod"}})
+    json_storage.put_member("test", "steve", {})
+    json_storage.create_group("other", "bob", {})
+
+    sqlite_storage = SqliteStorage(tmp_path / "guiltysync.db")
+    sqlite_storage.open()
+    try:
+        sqlite_storage.import_state(json_storage.state)
+        for group in ("test", "other"):
+            assert sqlite_storage.get_group(group) == json_storage.get_group(group)
+            assert sqlite_storage.get_group_changes(
+                group, 1
+            ) == json_storage.get_group_changes(group, 1)
+        # New versions carry on from the imported ones
+        sqlite_storage.put_member("other", "bob", {"2": {"name": "New"}})
+        assert sqlite_storage.get_group("other")[0] > json_storage.state["version"]
+    finally:
+        sqlite_storage.close()
+        json_storage.close()
+
+
+def test_batched_storage_coalesces_updates(tmp_path):
+    # Long enough that only the explicit flush() writes anything
+    storage = JsonStorage(
+        tmp_path / "config.json", durability="batched", flush_interval=60
+    )
+    storage.open()
+    try:
+        storage.create_group("test", "mike", {})
+        storage.put_member("test", "mike", {"1": {"name": "A"}})
+        storage.put_member("test", "mike", {"1": {"name": "B"}})
+        storage.delete_group("test")
+        storage.create_group("test", "steve", {})
+        storage.put_member("test", "mike", {"1": {"name": "C"}})
+        storage.flush()
+
+        entries = [
+            json.loads(line)
+            for line in storage.journal.journal_filepath.read_text().splitlines()
+        ]
+        # Only the latest update between two resets of the group is kept
+        assert [(entry["op"], entry.get("mods")) for entry in entries] == [
+            ("create_group", {}),
+            ("put_member", {"1": {"name": "B"}}),
+            ("delete_group", None),
+            ("create_group", {}),
+            ("put_member", {"1": {"name": "C"}}),
+        ]
+
+        recovered = JsonStorage(tmp_path / "config.json")
+        recovered.open()
+        assert recovered.get_group("test")[1] == {
+            "steve": {},
+            "mike": {"1": {"name": "C"}},
+        }
+        recovered.close()
+    finally:
+        storage.close()
+
+
+WIRE_MEMBERS = {
+    "mike": {"1": {"name": "Shared", "id": "1", "download_id": "10"}},
+    "steve": {
+        "1": {"name": "Shared", "id": "1", "download_id": "10"},
+        "2": {"name": "Own", "id": "2", "download_id": "20"},
+    },
+    "bob": {"1": {"name": "Shared", "id": "1", "download_id": "11"}},
+    "alice": {},
+}
+
+
+def json_response(data, headers: dict | None = None) -> requests.Response:
+    res = requests.Response()
+    res.status_code = 200
+    res._content = json.dumps(data).encode()
+    res.headers.update(headers or {})
+    return res
+
+
+def test_compact_members_round_trip():
+    compact = compact_members(WIRE_MEMBERS)
+
+    # The mod shared by mike and steve is only sent once
+    assert len(compact["mods"]) == 3
+    assert compact["members"]["mike"] == compact["members"]["steve"][:1]
+    assert expand_members(json.loads(json.dumps(compact))) == WIRE_MEMBERS
+
+    # Expanded members don't share mod data
+    expanded = expand_members(compact)
+    expanded["mike"]["1"]["name"] = "Changed"
+    assert expanded["steve"]["1"]["name"] == "Shared"
+
+
+def test_wire_reads_both_formats():
+    compact_header = {FORMAT_HEADER: COMPACT_FORMAT}
+    compact = compact_members(WIRE_MEMBERS)
+    assert read_group(json_response(compact, compact_header)) == WIRE_MEMBERS
+    # Servers without the compact format answer in the old, full format
+    assert read_group(json_response(WIRE_MEMBERS)) == WIRE_MEMBERS
+
+    changes = {"version": 3, "full": False, "members": WIRE_MEMBERS}
+    compact = compact_changes(changes)
+    assert read_changes(json_response(compact, compact_header)) == changes
+    assert read_changes(json_response(changes)) == changes
+
+
+class FakeClock:
+    # Stands in for the time module, so throttled transfers don't really wait
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_download_throttle_rate(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(guiltysync.throttle, "time", clock)
+    throttle = DownloadThrottle(1000, pause_while_playing=False)
+
+    # A second's worth can be used straight away, then transfers wait for their share
+    throttle.consume(1000)
+    throttle.consume(500)
+    throttle.consume(500)
+    assert clock.sleeps == [0.5, 0.5]
+
+    # Idle time is only saved up to a second's worth
+    clock.now += 10
+    throttle.consume(1500)
+    assert clock.sleeps[2:] == [0.5]
+
+
+def test_download_throttle_pauses_while_game_runs(monkeypatch):
+    clock = FakeClock()
+    running = [True, True, True]
+    monkeypatch.setattr(guiltysync.throttle, "time", clock)
+    monkeypatch.setattr(
+        guiltysync.throttle, "game_running", lambda: bool(running and running.pop())
+    )
+    throttle = DownloadThrottle(1000, check_interval=5)
+
+    throttle.consume(1000)
+    assert throttle.pauses == 1
+    assert throttle.paused_seconds == 10
+    # Nothing is saved up during the pause, so this transfer waits for its share
+    assert clock.sleeps == [5, 5, 1]
+
+    # Once it has closed, the game isn't looked for again until check_interval passes
+    throttle.consume(0)
+    running.append(True)
+    clock.now += 1
+    throttle.consume(0)
+    assert running == [True]
+    clock.now += 5
+    throttle.consume(0)
+    assert throttle.pauses == 2
+
+
+def test_download_priority(tmp_path):
+    sizes = {"1": 500, "2": 100, "4": 50}
+    owners = {"1": 2, "2": 2, "3": 1, "4": 1, "5": 2}
+    members = ["steve", "bob"]
+    group_data = {member: {} for member in members}
+    for mod_id, count in owners.items():
+        for member in members[:count]:
+            group_data[member][mod_id] = {
+                "name": mod_id,
+                "id": mod_id,
+                "download_id": f"{mod_id}0",
+            }
+    plan = SyncPlan(group_data, {}, "mike")
+
+    client = SyncClient.__new__(SyncClient)
+    client.store = ModStore(tmp_path / "store", 1024 * 1024)
+    client.metadata_cache = MetadataCache(tmp_path / "cache.json", 3600, 1024 * 1024)
+    for mod_id, size in sizes.items():
+        client.metadata_cache.put(
+            MetadataCache.profile_key("Mod", mod_id),
+            {"_aFiles": [{"_idRow": f"{mod_id}0", "_nFilesize": size}]},
+        )
+
+    # Most owners first, then the smallest, with unknown sizes last
+    assert client.download_priority(plan, plan.to_download) == [
+        "2",
+        "1",
+        "5",
+        "4",
+        "3",
+    ]
+
+
 if __name__ == "__main__":
     # test_new_group()
     # test_existing_group()